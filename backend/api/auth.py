@@ -4,10 +4,11 @@ api/auth.py — Routes d'authentification JWT, login et setup initial.
 import os
 from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field, validator
 
-from database import SessionLocal, User, Setting
+from database import SessionLocal, User, Setting, USER_BY_USERNAME, invalidate_settings_cache
 from core.security import (
     get_db, 
     pwd_hasher, 
@@ -88,15 +89,15 @@ async def setup_admin(
         hashed_password=pwd_hasher.hash(setup_data.password)
     ))
     
-    # Initialiser les settings LLM
-    db.add(Setting(
-        key="llm_base_url", 
-        value=setup_data.llm_url or os.getenv("LLM_BASE_URL", "http://localhost:1234/v1")
-    ))
-    db.add(Setting(key="llm_model", value=os.getenv("LLM_MODEL", "local-model")))
-    db.add(Setting(key="llm_api_key", value=os.getenv("LLM_API_KEY", "lm-studio")))
+    # Initialiser les settings LLM (un seul INSERT multi-lignes)
+    db.execute(insert(Setting), [
+        {"key": "llm_base_url", "value": setup_data.llm_url or os.getenv("LLM_BASE_URL", "http://localhost:1234/v1")},
+        {"key": "llm_model", "value": os.getenv("LLM_MODEL", "local-model")},
+        {"key": "llm_api_key", "value": os.getenv("LLM_API_KEY", "lm-studio")},
+    ])
     
     db.commit()
+    invalidate_settings_cache()   # INSERT Core : non vu par les événements ORM
     
     log_security_event("SETUP_COMPLETED", {"username": setup_data.username}, request)
     return {"message": "Installation réussie"}
@@ -154,7 +155,7 @@ def refresh_token_endpoint(
         raise HTTPException(status_code=401, detail="Invalid refresh token")
     
     # Vérifier que l'utilisateur existe toujours
-    user = db.query(User).filter(User.username == username).first()
+    user = db.execute(USER_BY_USERNAME, {"username": username}).scalar_one_or_none()
     if not user:
         log_security_event("REFRESH_FAILED", {"username": username, "reason": "user_not_found"}, request)
         raise HTTPException(status_code=401, detail="User not found")
@@ -1,28 +1,53 @@
 """
 api/documents.py — Routes CRUD documents, upload et recherche.
 """
+import io
 import os
+import hashlib
 import re
 import json
+import datetime
+import shutil
 import logging
 
-from fastapi import APIRouter, UploadFile, File, BackgroundTasks, Depends, Query, HTTPException, Request
+from fastapi import APIRouter, UploadFile, File, Depends, Query, HTTPException, Request, Response
 from fastapi.responses import FileResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy import select, or_, bindparam, text, column, func, Integer
+from pydantic import BaseModel, ConfigDict
 
-from database import Document, User
+from database import Document, User, FTS_ENABLED, DOCUMENT_BY_ID, DOCUMENTS_VERSION
 from core.security import get_db, get_current_user, log_security_event, create_file_token, verify_file_token
-from core.config import UPLOAD_DIR
+from core.config import UPLOAD_DIR, MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE
 from core.validators import validate_file_upload, validate_file_content, sanitize_filename
 from core.middleware import limiter
-from services.processing import run_processing
+from services.processing import enqueue_processing
+from processor import forget_llm_cache
+from prompts import SEARCH_SYSTEM_PROMPT
 
 logger = logging.getLogger(__name__)
 router = APIRouter(tags=["Documents"])
 
+# Sous-requête plein texte sur l'index FTS5 (trigram : sous-chaînes d'au moins 3 caractères)
+_FTS_IDS = text("SELECT rowid FROM documents_fts WHERE documents_fts MATCH :q").columns(column("rowid", Integer))
+
+
+def _search_filter(q: str):
+    """Filtre de recherche : index FTS5 si disponible, sinon LIKE sur chaque colonne."""
+    if FTS_ENABLED and len(q) >= 3:
+        phrase = '"' + q.replace('"', '""') + '"'
+        return Document.id.in_(_FTS_IDS.bindparams(q=phrase))
+    needle = bindparam("q", q)
+    return or_(
+        Document.content.contains(needle),
+        Document.filename.contains(needle),
+        Document.category.contains(needle),
+        Document.issuer.contains(needle),
+        Document.summary.contains(needle),
+    )
+
 
 # ---------------------------------------------------------------------------
 # Pydantic Models
@@ -36,15 +61,74 @@ class FormDataUpdate(BaseModel):
     summary: str = None
 
 
+class DocumentSummary(BaseModel):
+    """Métadonnées d'un document pour les listes — sans le texte OCR complet."""
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    filename: str
+    category: str | None = None
+    doc_date: str | None = None
+    amount: str | None = None
+    issuer: str | None = None
+    summary: str | None = None
+    created_at: datetime.datetime | None = None
+
+
+class DocumentSearchResult(DocumentSummary):
+    content: str | None = None   # extrait (800 premiers caractères)
+
+
+_SUMMARY_COLUMNS = (
+    Document.id, Document.filename, Document.category, Document.doc_date,
+    Document.amount, Document.issuer, Document.summary, Document.created_at,
+)
+_SNIPPET_LENGTH = 800
+# Préfixe précalculé : les noms stockés en base sont de simples noms de fichiers
+_UPLOAD_PREFIX = os.path.join(UPLOAD_DIR, "")
+# Colonnes sélectionnables via /documents/{id}?fields=
+_DETAIL_FIELDS = {c.key: getattr(Document, c.key) for c in Document.__table__.columns}
+_CONTEXT_BUDGET = 6000      # taille max (caractères) du contexte documents envoyé au LLM
+_CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+
 # ---------------------------------------------------------------------------
 # Upload
 # ---------------------------------------------------------------------------
 
+def _write_upload(src, file_path: str, head: bytes) -> int:
+    """
+    Écrit l'en-tête déjà lu puis copie le reste du flux par blocs. Retourne la taille totale.
+    Un reste n'existe que si l'upload dépasse un bloc, donc a débordé sur disque
+    (SpooledTemporaryFile > 1 MB) : s'il a un descripteur de fichier, copie noyau
+    à noyau via os.sendfile, sans passer par des buffers Python.
+    """
+    with open(file_path, "wb") as f:
+        f.write(head)
+        if len(head) < UPLOAD_CHUNK_SIZE:
+            return f.tell()    # flux déjà lu en entier
+        src_fd = None
+        if hasattr(os, "sendfile"):
+            try:
+                src_fd = src.fileno()
+            except (io.UnsupportedOperation, AttributeError):
+                pass           # flux en mémoire ou sans descripteur → copie classique
+        if src_fd is not None:
+            f.flush()
+            offset = src.tell()
+            try:
+                while n := os.sendfile(f.fileno(), src_fd, offset, UPLOAD_CHUNK_SIZE):
+                    offset += n
+                return f.tell()
+            except OSError:
+                src.seek(offset)   # sendfile refusé (FS exotique) → copie classique
+        shutil.copyfileobj(src, f, UPLOAD_CHUNK_SIZE)
+        return f.tell()
+
+
 @router.post("/upload")
 @limiter.limit("20/minute")
 async def upload_document(
     request: Request,
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
@@ -56,32 +140,39 @@ async def upload_document(
     # Validation avant lecture du contenu
     validate_file_upload(file)
     
-    # Lecture et validation du contenu
-    content = await file.read()
-    await validate_file_content(file, content)
+    # Lecture du seul premier bloc (magic bytes) — le reste est copié en flux
+    head = await file.read(UPLOAD_CHUNK_SIZE)
+    size = file.size if file.size is not None else len(head)
+    await validate_file_content(file, head, size)
     
     # Nom de fichier sécurisé
     original_name = file.filename or "document"
     safe_name = sanitize_filename(original_name)
     
-    logger.info(f"[upload] User={current_user.username} | '{original_name}' → '{safe_name}' | size={len(content)} bytes | type={file.content_type}")
+    logger.info(f"[upload] User={current_user.username} | '{original_name}' → '{safe_name}' | size={size} bytes | type={file.content_type}")
 
     # Gestion des doublons
     base, ext = os.path.splitext(safe_name)
-    file_path = os.path.join(UPLOAD_DIR, safe_name)
+    file_path = _UPLOAD_PREFIX + safe_name
     counter = 1
     while os.path.exists(file_path):
         safe_name = f"{base}_{counter}{ext}"
-        file_path = os.path.join(UPLOAD_DIR, safe_name)
+        file_path = _UPLOAD_PREFIX + safe_name
         counter += 1
 
-    # Sauvegarde sécurisée
+    # Sauvegarde sécurisée (copie par blocs hors de la boucle d'événements)
     try:
-        with open(file_path, "wb") as f:
-            f.write(content)
+        written = await run_in_threadpool(_write_upload, file.file, file_path, head)
     except Exception as e:
         logger.error(f"[upload] Failed to write file: {e}")
         raise HTTPException(status_code=500, detail="Erreur lors de l'écriture du fichier")
+    if written > MAX_UPLOAD_SIZE:
+        os.remove(file_path)
+        logger.warning(f"Rejected upload - file too large: {written} bytes for {file.filename}")
+        raise HTTPException(
+            status_code=413,
+            detail=f"Fichier trop volumineux. Taille maximale: {MAX_UPLOAD_SIZE // (1024*1024)} MB"
+        )
 
     # Création de l'entrée DB
     db_doc = Document(filename=safe_name, content=None, category=None, summary=None)
@@ -92,7 +183,7 @@ async def upload_document(
     logger.info(f"[upload] Doc #{db_doc.id} créé, traitement en arrière-plan...")
     log_security_event("DOCUMENT_UPLOADED", {"doc_id": db_doc.id, "filename": safe_name, "user": current_user.username}, request)
     
-    background_tasks.add_task(run_processing, db_doc.id, file_path)
+    enqueue_processing(db_doc.id, file_path)
     return {"status": "processing", "doc_id": db_doc.id, "filename": safe_name}
 
 
@@ -104,34 +195,49 @@ async def upload_document(
 @limiter.limit("100/minute")
 def list_documents(
     request: Request,
+    response: Response,
     q: str = Query(None),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    query = db.query(Document)
+    # ETag = version de la table documents (+ filtre) : liste inchangée → 304 sans requête ni JSON
+    version = db.execute(DOCUMENTS_VERSION).scalar()
+    etag = '"' + hashlib.sha1(f"{version}-{q or ''}".encode()).hexdigest() + '"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (t.strip().removeprefix("W/") for t in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    query = db.query(*_SUMMARY_COLUMNS)
     if q:
-        query = query.filter(
-            or_(
-                Document.content.contains(q),
-                Document.filename.contains(q),
-                Document.category.contains(q),
-                Document.issuer.contains(q),
-                Document.summary.contains(q),
-            )
-        )
-    return query.order_by(Document.created_at.desc()).all()
+        query = query.filter(_search_filter(q))
+    return [DocumentSummary.model_validate(row) for row in query.order_by(Document.created_at.desc()).all()]
 
 
 @router.get("/documents/{doc_id}")
 def get_document(
     doc_id: int,
+    fields: str = Query(None, description="Colonnes à renvoyer, séparées par des virgules (ex: category,issuer)"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    if not fields:
+        doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
+        if not doc:
+            raise HTTPException(status_code=404, detail="Document introuvable")
+        return doc
+
+    # Chargement partiel : le texte OCR (content) n'est lu que s'il est demandé
+    wanted = ["id"] + [f for f in dict.fromkeys(fields.split(",")) if f in _DETAIL_FIELDS and f != "id"]
+    stmt = (
+        select(Document)
+        .options(load_only(*(_DETAIL_FIELDS[f] for f in wanted)))
+        .where(Document.id == doc_id)
+    )
+    doc = db.execute(stmt).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
-    return doc
+    return {f: getattr(doc, f) for f in wanted}
 
 
 # ---------------------------------------------------------------------------
@@ -147,7 +253,7 @@ def update_form_data(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
     doc.form_data = json.dumps(form_data, ensure_ascii=False)
@@ -174,20 +280,20 @@ def delete_document(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
     
     # Suppression des fichiers
-    file_path = os.path.join(UPLOAD_DIR, doc.filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    if doc.pdf_filename:
-        pdf_path = os.path.join(UPLOAD_DIR, doc.pdf_filename)
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
+    for name in (doc.filename, doc.pdf_filename):
+        if name:
+            try:
+                os.remove(_UPLOAD_PREFIX + name)
+            except FileNotFoundError:
+                pass
     
     db.delete(doc)
+    forget_llm_cache(db, doc_id)
     db.commit()
     
     log_security_event("DOCUMENT_DELETED", {"doc_id": doc_id, "filename": doc.filename, "user": current_user.username}, request)
@@ -198,6 +304,11 @@ def delete_document(
 # Téléchargement fichiers
 # ---------------------------------------------------------------------------
 
+class _FileResponse(FileResponse):
+    """FileResponse lisant par blocs de 1 MB (64 KB par défaut) quand sendfile n'est pas utilisé."""
+    chunk_size = 1024 * 1024
+
+
 @router.get("/documents/{doc_id}/file-token")
 def get_file_token(
     doc_id: int,
@@ -208,7 +319,7 @@ def get_file_token(
     Génère un token signé 60s pour accéder au fichier sans header Authorization.
     Utilisé par le frontend pour construire l'URL de l'<iframe>.
     """
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
     token = create_file_token(doc_id=doc_id, username=current_user.username)
@@ -235,18 +346,21 @@ def download_document(
     else:
         raise HTTPException(status_code=401, detail="Authentification requise", headers={"WWW-Authenticate": "Bearer"})
 
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
-    file_path = os.path.join(UPLOAD_DIR, doc.filename)
-    if not os.path.exists(file_path):
+    file_path = _UPLOAD_PREFIX + doc.filename
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Fichier physique introuvable")
 
     # ?token= → aperçu inline (iframe) | Bearer → téléchargement forcé
     disposition = "inline" if token else "attachment"
-    return FileResponse(
+    return _FileResponse(
         file_path,
         filename=doc.filename,
+        stat_result=st,
         headers={"Content-Disposition": f'{disposition}; filename="{doc.filename}"'},
     )
 
@@ -269,20 +383,23 @@ def get_document_pdf(
     else:
         raise HTTPException(status_code=401, detail="Authentification requise", headers={"WWW-Authenticate": "Bearer"})
 
-    doc = db.query(Document).filter(Document.id == doc_id).first()
+    doc = db.execute(DOCUMENT_BY_ID, {"id": doc_id}).scalar_one_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
     if not doc.pdf_filename:
         raise HTTPException(status_code=404, detail="Aucun PDF généré pour ce document")
-    pdf_path = os.path.join(UPLOAD_DIR, doc.pdf_filename)
-    if not os.path.exists(pdf_path):
+    pdf_path = _UPLOAD_PREFIX + doc.pdf_filename
+    try:
+        st = os.stat(pdf_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Fichier PDF introuvable")
 
     # ?token= → aperçu inline (iframe) | Bearer → téléchargement forcé
     disposition = "inline" if token else "attachment"
-    return FileResponse(
+    return _FileResponse(
         pdf_path,
         filename=doc.pdf_filename,
+        stat_result=st,
         media_type="application/pdf",
         headers={"Content-Disposition": f'{disposition}; filename="{doc.pdf_filename}"'},
     )
@@ -292,6 +409,16 @@ def get_document_pdf(
 # Recherche
 # ---------------------------------------------------------------------------
 
+def get_search_llm() -> tuple:
+    """
+    Client OpenAI + modèle utilisés par /search?mode=llm : config lue depuis le
+    cache des settings, client partagé avec le traitement (processor.openai_client).
+    """
+    from processor import get_llm_config, openai_client
+    config = get_llm_config()
+    return openai_client(config["base_url"], config["api_key"]), config["model"]
+
+
 @router.get("/search")
 def search_documents(
     q: str = Query(...),
@@ -299,15 +426,14 @@ def search_documents(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    results = db.query(Document).filter(
-        or_(
-            Document.content.contains(q),
-            Document.filename.contains(q),
-            Document.category.contains(q),
-            Document.issuer.contains(q),
-            Document.summary.contains(q),
-        )
-    ).order_by(Document.created_at.desc()).limit(10).all()
+    rows = (
+        db.query(*_SUMMARY_COLUMNS, func.substr(Document.content, 1, _SNIPPET_LENGTH).label("content"))
+        .filter(_search_filter(q))
+        .order_by(Document.created_at.desc())
+        .limit(10)
+        .all()
+    )
+    results = [DocumentSearchResult.model_validate(row) for row in rows]
 
     if mode == "text":
         return {"mode": "text", "results": results, "llm_answer": None}
@@ -315,26 +441,28 @@ def search_documents(
     if not results:
         return {"mode": "llm", "results": [], "llm_answer": "Aucun document correspondant trouvé."}
 
-    context_parts = []
+    # Contexte borné à _CONTEXT_BUDGET caractères : taille (et coût) du prompt prévisible
+    buf = io.StringIO()
+    buf.write(f"Question : {q}\n\nDocuments :\n\n")
+    total = 0
     for doc in results:
-        snippet = (doc.content or "")[:800]
-        context_parts.append(
-            f"[{doc.filename} | {doc.category} | {doc.doc_date} | {doc.issuer}]\n{snippet}"
-        )
+        if total >= _CONTEXT_BUDGET:
+            break
+        if total:
+            buf.write(_CONTEXT_SEPARATOR)
+        header = "[" + " | ".join(map(str, (doc.filename, doc.category, doc.doc_date, doc.issuer))) + "]\n"
+        snippet = (doc.content or "")[:max(0, _CONTEXT_BUDGET - total - len(header))]
+        buf.write(header)
+        buf.write(snippet)
+        total += len(header) + len(snippet)
 
     try:
-        from processor import get_llm_config
-        from openai import OpenAI
-        config = get_llm_config()
-        client = OpenAI(base_url=config["base_url"], api_key=config["api_key"])
+        client, model = get_search_llm()
         response = client.chat.completions.create(
-            model=config["model"],
+            model=model,
             messages=[
-                {"role": "system", "content": (
-                    "Tu es un assistant qui aide à retrouver des informations dans des documents administratifs. "
-                    "Réponds en français, de façon concise, uniquement à partir des documents fournis."
-                )},
-                {"role": "user", "content": f"Question : {q}\n\nDocuments :\n\n" + "\n\n---\n\n".join(context_parts)},
+                {"role": "system", "content": SEARCH_SYSTEM_PROMPT},
+                {"role": "user", "content": buf.getvalue()},
             ],
             temperature=0.2,
         )
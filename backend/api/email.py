@@ -6,7 +6,7 @@ from fastapi import APIRouter, BackgroundTasks, Depends, Query, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from sqlalchemy.orm import Session
 
-from database import Setting, User, EmailLog
+from database import User, EmailLog, get_settings_dict
 from core.security import get_db, get_current_user
 from core.config import UPLOAD_DIR
 import email_monitor
@@ -21,7 +21,7 @@ router = APIRouter(prefix="/email", tags=["Email"])
 
 def _get_email_creds(db: Session):
     """Lit host/user/password depuis la DB. Lève 400 si non configuré."""
-    settings = {s.key: s.value for s in db.query(Setting).all()}
+    settings = get_settings_dict()
     host = settings.get("email_host", "")
     user = settings.get("email_user", "")
     pwd  = settings.get("email_password", "")
@@ -43,7 +43,7 @@ def test_email_connection(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    settings = {s.key: s.value for s in db.query(Setting).all()}
+    settings = get_settings_dict()
     host = settings.get("email_host", "")
     user = settings.get("email_user", "")
     pwd  = settings.get("email_password", "")
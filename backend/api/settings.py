@@ -4,7 +4,7 @@ api/settings.py — Routes de gestion des paramètres applicatifs et des backend
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 
-from database import Setting, User
+from database import Setting, User, get_settings_dict
 from core.security import get_db, get_current_user
 
 router = APIRouter(tags=["Settings"])
@@ -54,10 +54,9 @@ def get_backends():
 
 @router.get("/settings")
 def get_settings(
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    return {s.key: s.value for s in db.query(Setting).all()}
+    return get_settings_dict()
 
 
 @router.post("/settings")
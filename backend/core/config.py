@@ -15,6 +15,9 @@ WATCH_DIR  = os.getenv("WATCH_DIR",  "./storage/watch")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(WATCH_DIR,  exist_ok=True)
 
+# Traitement OCR + LLM en arrière-plan : nombre de documents traités simultanément
+PROCESSING_CONCURRENCY = max(1, int(os.getenv("PROCESSING_CONCURRENCY", "2")))
+
 # Sécurité JWT
 SECRET_KEY = os.getenv("SECRET_KEY", "")
 if not SECRET_KEY or SECRET_KEY == "changeme-please-generate-a-random-string":
@@ -22,12 +25,16 @@ if not SECRET_KEY or SECRET_KEY == "changeme-please-generate-a-random-string":
     print("   Generate a secure key with: python -c 'import secrets; print(secrets.token_urlsafe(32))'")
     SECRET_KEY = secrets.token_urlsafe(32)  # Fallback temporaire
 
+# Coût Argon2 du hachage des mots de passe (paramètres stockés dans le hash : les anciens restent valides)
+ARGON2_TIME_COST = max(1, int(os.getenv("ARGON2_TIME_COST", "3")))
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 REFRESH_TOKEN_EXPIRE_DAYS = 30
 
 # Sécurité uploads
 MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # 50 MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024     # 1 MB — copie des uploads par blocs
 ALLOWED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
 ALLOWED_MIME_TYPES = {
     "application/pdf",
@@ -18,6 +18,13 @@ class SensitiveFilter(logging.Filter):
 
     def filter(self, record: logging.LogRecord) -> bool:
         record.msg = self._mask(str(record.msg))
+        args = record.args
+        # uvicorn.access : args = (host, method, path, http_version, status)
+        # → seul le path peut contenir une valeur sensible
+        if record.name == "uvicorn.access" and isinstance(args, tuple) and len(args) >= 3:
+            path = args[2]
+            record.args = (args[0], args[1], self._mask(path) if isinstance(path, str) else path) + args[3:]
+            return True
         if record.args:
             if isinstance(record.args, tuple):
                 record.args = tuple(
@@ -1,21 +1,32 @@
 """
 core/security.py — Authentification JWT, gestion des tokens et sécurité.
 """
+import hashlib
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
 from sqlalchemy.orm import Session
 import logging
 
-from database import SessionLocal, User
-from core.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
+from database import SessionLocal, User, USER_BY_USERNAME
+from core.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, ARGON2_TIME_COST
 
 logger = logging.getLogger(__name__)
 security = HTTPBearer()
-pwd_hasher = PasswordHash.recommended()
+pwd_hasher = PasswordHash((Argon2Hasher(time_cost=ARGON2_TIME_COST),))
+
+# Cache des access tokens déjà vérifiés : sha256(token) → (user_id, valide_jusqu'à)
+# Évite le décodage JWT + la recherche par username à chaque requête authentifiée.
+_AUTH_CACHE_TTL = 60      # secondes (borné par l'expiration du token)
+_AUTH_CACHE_MAX = 256
+_auth_cache: dict[bytes, tuple[int, float]] = {}
+_auth_cache_lock = threading.Lock()
 
 
 def get_db():
@@ -67,6 +78,15 @@ def get_current_user(
 ) -> User:
     """Récupère l'utilisateur courant depuis le JWT token."""
     token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    with _auth_cache_lock:
+        cached = _auth_cache.get(cache_key)
+    if cached and cached[1] > now:
+        user = db.get(User, cached[0])
+        if user is not None:
+            return user
+
     payload = verify_token(token, "access")
     username: str = payload.get("sub")
     
@@ -76,20 +96,24 @@ def get_current_user(
             detail="Could not validate credentials"
         )
     
-    user = db.query(User).filter(User.username == username).first()
+    user = db.execute(USER_BY_USERNAME, {"username": username}).scalar_one_or_none()
     if user is None:
         logger.warning(f"User not found in database: {username}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
-    
+
+    with _auth_cache_lock:
+        if len(_auth_cache) >= _AUTH_CACHE_MAX:
+            _auth_cache.pop(next(iter(_auth_cache)))  # éviction de la plus ancienne entrée
+        _auth_cache[cache_key] = (user.id, min(now + _AUTH_CACHE_TTL, payload.get("exp", now)))
     return user
 
 
 def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
     """Authentifie un utilisateur et log les tentatives échouées."""
-    user = db.query(User).filter(User.username == username).first()
+    user = db.execute(USER_BY_USERNAME, {"username": username}).scalar_one_or_none()
     if not user:
         logger.warning(f"Failed login attempt - user not found: {username}")
         return None
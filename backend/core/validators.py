@@ -38,14 +38,15 @@ def validate_file_upload(file: UploadFile) -> None:
         )
 
 
-async def validate_file_content(file: UploadFile, content: bytes) -> None:
+async def validate_file_content(file: UploadFile, content: bytes, size: int | None = None) -> None:
     """
     Valide le contenu réel du fichier :
-    - Taille
-    - Type MIME réel (magic bytes)
+    - Taille (size si fournie, sinon len(content))
+    - Type MIME réel (magic bytes) — content peut n'être que le début du fichier
     """
     # Vérifier la taille
-    size = len(content)
+    if size is None:
+        size = len(content)
     if size == 0:
         raise HTTPException(status_code=400, detail="Fichier vide")
     
@@ -1,18 +1,40 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, select, bindparam, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import datetime
-import os
+import threading
 
 import os
 _db_dir = os.getenv("DB_DIR", "./storage")
 os.makedirs(_db_dir, exist_ok=True)
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{_db_dir}/paperfree.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    query_cache_size=1200,
+)
+
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL : les lectures ne sont plus bloquées par le traitement en arrière-plan qui écrit."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def utcnow() -> datetime.datetime:
+    """Heure UTC naïve, comme stockée dans les colonnes DateTime (remplace datetime.utcnow, déprécié)."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 class Document(Base):
     __tablename__ = "documents"
     id = Column(Integer, primary_key=True, index=True)
@@ -76,8 +98,21 @@ class EmailLog(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
+class LLMCacheEntry(Base):
+    """Réponses LLM déjà obtenues, par empreinte de la requête (voir processor._chat_completion)."""
+    __tablename__ = "llm_cache"
+    key     = Column(String, primary_key=True)            # SHA-256 hex de la requête
+    content = Column(Text, nullable=False)                # Réponse brute du LLM
+    doc_id  = Column(Integer, nullable=False, index=True) # Document source (purgé avec lui)
+    used_at = Column(DateTime, default=utcnow, index=True)  # Dernière utilisation (LRU/TTL)
+
+
 Base.metadata.create_all(bind=engine)
 
+# Requêtes point-lookup précompilées : SQL stable + paramètres liés → cache de compilation SQLAlchemy
+DOCUMENT_BY_ID   = select(Document).where(Document.id == bindparam("id"))
+USER_BY_USERNAME = select(User).where(User.username == bindparam("username"))
+
 # Migration légère : ajouter les colonnes manquantes si la DB existait déjà
 def _run_migrations():
     import sqlite3
@@ -163,6 +198,83 @@ def _run_migrations():
 _run_migrations()
 
 
+# ---------------------------------------------------------------------------
+# Recherche plein texte : table FTS5 (tokenizer trigram) synchronisée par triggers
+# ---------------------------------------------------------------------------
+FTS_COLUMNS = ("filename", "content", "category", "issuer", "summary")
+
+def _init_fulltext_search() -> bool:
+    """Crée documents_fts + triggers si absents. Retourne False si FTS5/trigram indisponible."""
+    import sqlite3
+    cols = ", ".join(FTS_COLUMNS)
+    new_vals = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_vals = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    conn = sqlite3.connect(SQLALCHEMY_DATABASE_URL.replace("sqlite:///", ""))
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='documents_fts'")
+        if cur.fetchone():
+            return True
+        cur.execute(f"""
+            CREATE VIRTUAL TABLE documents_fts USING fts5(
+                {cols}, content='documents', content_rowid='id', tokenize='trigram'
+            )
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER documents_fts_ai AFTER INSERT ON documents BEGIN
+                INSERT INTO documents_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER documents_fts_ad AFTER DELETE ON documents BEGIN
+                INSERT INTO documents_fts(documents_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER documents_fts_au AFTER UPDATE ON documents BEGIN
+                INSERT INTO documents_fts(documents_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO documents_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        # Indexer les documents déjà présents
+        cur.execute("INSERT INTO documents_fts(documents_fts) VALUES ('rebuild')")
+        conn.commit()
+        return True
+    except sqlite3.OperationalError:
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+FTS_ENABLED = _init_fulltext_search()
+
+
+# ---------------------------------------------------------------------------
+# Compteur de modifications de la table documents (ETag de GET /documents)
+# ---------------------------------------------------------------------------
+def _init_change_counter():
+    """Table à une ligne incrémentée par triggers à chaque INSERT/UPDATE/DELETE sur documents."""
+    import sqlite3
+    conn = sqlite3.connect(SQLALCHEMY_DATABASE_URL.replace("sqlite:///", ""))
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS documents_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+        cur.execute("INSERT OR IGNORE INTO documents_version (id, version) VALUES (1, 0)")
+        for suffix, op in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS documents_version_{suffix} AFTER {op} ON documents BEGIN
+                    UPDATE documents_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+
+_init_change_counter()
+
+DOCUMENTS_VERSION = text("SELECT version FROM documents_version WHERE id = 1")
+
+
 # ---------------------------------------------------------------------------
 # Valeurs par défaut des settings email (insérées si absentes)
 # ---------------------------------------------------------------------------
@@ -225,3 +337,61 @@ def init_email_defaults():
         db.close()
 
 init_email_defaults()
+
+
+# ---------------------------------------------------------------------------
+# Cache mémoire des settings (lecture fréquente, écriture rare)
+# ---------------------------------------------------------------------------
+_settings_cache: dict[str, str] | None = None
+_settings_lock = threading.Lock()
+
+
+def _cached_settings() -> dict[str, str]:
+    """Dict du cache, chargé depuis la DB au premier accès. L'appelant détient _settings_lock."""
+    global _settings_cache
+    if _settings_cache is None:
+        db = SessionLocal()
+        try:
+            _settings_cache = {s.key: s.value for s in db.query(Setting).all()}
+        finally:
+            db.close()
+    return _settings_cache
+
+
+def get_settings_dict() -> dict[str, str]:
+    """Copie des settings clé → valeur : une seule lecture DB, puis servie depuis la mémoire."""
+    with _settings_lock:
+        return dict(_cached_settings())
+
+
+def get_setting_values(*keys: str) -> dict[str, str]:
+    """Seules les clés demandées (absentes du dict si inexistantes), sans copier toute la table."""
+    with _settings_lock:
+        settings = _cached_settings()
+        return {key: settings[key] for key in keys if key in settings}
+
+
+def invalidate_settings_cache():
+    """À appeler après une écriture hors ORM (insert/update Core) sur la table settings."""
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
+
+# Toute écriture ORM sur Setting invalide le cache après le commit (jamais avant :
+# une relecture concurrente verrait encore l'ancienne valeur)
+@event.listens_for(SessionLocal, "after_flush")
+def _flag_settings_write(session, flush_context):
+    if any(isinstance(obj, Setting) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["settings_changed"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("settings_changed", False):
+        invalidate_settings_cache()
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _clear_settings_flag(session):
+    session.info.pop("settings_changed", None)
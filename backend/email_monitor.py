@@ -19,7 +19,7 @@ import logging
 from datetime import datetime, timezone, timedelta
 from email.utils import parsedate_to_datetime
 from typing import Optional
-from prompts import EMAIL_CLASSIFIER_PROMPT
+from prompts import EMAIL_CLASSIFIER_PROMPT, EMAIL_BATCH_CLASSIFIER_PROMPT
 
 logger = logging.getLogger(__name__)
 
@@ -386,14 +386,21 @@ def download_attachments(host: str, user: str, password: str,
 # Détection LLM + suppression des promotionnels
 # ---------------------------------------------------------------------------
 
+def _llm_client(llm_config: dict):
+    """Client OpenAI sur le pool de connexions partagé avec le traitement des documents."""
+    from openai import OpenAI
+    from processor import llm_http_client
+    return OpenAI(base_url=llm_config["base_url"], api_key=llm_config["api_key"],
+                  http_client=llm_http_client())
+
+
 def _classify_email_llm(subject: str, sender: str, llm_config: dict) -> str:
     """
     Utilise le LLM pour classifier un email.
     Retourne : Promotionnel, Facture, Notification, Personnel, Autre
     """
     try:
-        from openai import OpenAI
-        client = OpenAI(base_url=llm_config["base_url"], api_key=llm_config["api_key"])
+        client = _llm_client(llm_config)
         response = client.chat.completions.create(
             model=llm_config["model"],
             messages=[
@@ -403,17 +410,70 @@ def _classify_email_llm(subject: str, sender: str, llm_config: dict) -> str:
             temperature=0,
             max_tokens=10,
         )
-        result = response.choices[0].message.content.strip()
-        valid = {"Promotionnel", "Facture", "Notification", "Personnel", "Autre"}
-        for v in valid:
-            if v.lower() in result.lower():
-                return v
-        return "Autre"
+        return _match_category(response.choices[0].message.content)
     except Exception as e:
         logger.error(f"[email] Erreur classification LLM: {e}")
         return "Autre"
 
 
+_EMAIL_CATEGORIES = ("Promotionnel", "Facture", "Notification", "Personnel", "Autre")
+# Emails classés par appel LLM lors d'une purge
+_CLASSIFY_BATCH_SIZE = 20
+# Budget de réponse d'un lot : tokens par email + enveloppe JSON
+_CLASSIFY_TOKENS_PER_EMAIL = 16
+_CLASSIFY_TOKENS_OVERHEAD = 64
+
+
+def _match_category(answer) -> str:
+    """Catégorie reconnue dans la réponse du LLM, « Autre » sinon."""
+    answer = str(answer or "").lower()
+    for category in _EMAIL_CATEGORIES:
+        if category.lower() in answer:
+            return category
+    return "Autre"
+
+
+def _classify_emails_llm(emails: list[tuple[str, str]], llm_config: dict) -> list[str]:
+    """
+    Classe plusieurs emails (sujet, expéditeur) en un seul appel LLM : le prompt
+    système n'est envoyé qu'une fois pour tout le lot.
+    Repli email par email si la réponse est inexploitable.
+    """
+    if len(emails) == 1:
+        return [_classify_email_llm(*emails[0], llm_config)]
+    try:
+        client = _llm_client(llm_config)
+        listing = "\n".join(
+            f"{i}. Sujet: {subject[:200]}\n   Expéditeur: {sender[:100]}"
+            for i, (subject, sender) in enumerate(emails, 1)
+        )
+        response = client.chat.completions.create(
+            model=llm_config["model"],
+            messages=[
+                {"role": "system", "content": EMAIL_BATCH_CLASSIFIER_PROMPT},
+                {"role": "user", "content": listing},
+            ],
+            temperature=0,
+            # Large : fences ```json et JSON indenté (une catégorie par ligne) comptent aussi
+            max_tokens=_CLASSIFY_TOKENS_PER_EMAIL * len(emails) + _CLASSIFY_TOKENS_OVERHEAD,
+        )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            logger.warning(
+                f"[email] Classification groupée tronquée (max_tokens atteint) — "
+                f"repli email par email pour {len(emails)} emails"
+            )
+            return [_classify_email_llm(subject, sender, llm_config) for subject, sender in emails]
+        raw = choice.message.content or ""
+        categories = json.loads(raw[raw.find("{"):raw.rfind("}") + 1])["categories"]
+        if len(categories) == len(emails):
+            return [_match_category(c) for c in categories]
+        logger.warning(f"[email] Classification groupée : {len(categories)} réponses pour {len(emails)} emails")
+    except Exception as e:
+        logger.warning(f"[email] Classification groupée impossible, email par email : {e}")
+    return [_classify_email_llm(subject, sender, llm_config) for subject, sender in emails]
+
+
 def purge_promotional_emails(host: str, user: str, password: str,
                              llm_config: dict,
                              folder: str = "INBOX",
@@ -447,6 +507,7 @@ def purge_promotional_emails(host: str, user: str, password: str,
         report["total"] = len(uids)
         logger.info(f"[email] Purge promotionnels — {len(uids)} emails dans '{folder}' (cutoff: {cutoff})")
 
+        candidates = []   # (uid, sujet, expéditeur) des emails à classer
         for uid in uids:
             uid_b = _uid_bytes(uid)
             try:
@@ -472,9 +533,19 @@ def purge_promotional_emails(host: str, user: str, password: str,
                         pass
 
                 report["analysed"] += 1
-                category = _classify_email_llm(subject, sender, llm_config)
-                logger.info(f"[email] [{category}] {subject[:50]} | {sender[:30]}")
+                candidates.append((uid_b, subject, sender))
 
+            except Exception as e:
+                logger.warning(f"[email] Erreur uid {uid}: {e}")
+                report["errors"] += 1
+                continue
+
+        # Classification par lots : un appel LLM pour _CLASSIFY_BATCH_SIZE emails
+        for start in range(0, len(candidates), _CLASSIFY_BATCH_SIZE):
+            batch = candidates[start:start + _CLASSIFY_BATCH_SIZE]
+            categories = _classify_emails_llm([(subject, sender) for _, subject, sender in batch], llm_config)
+            for (uid_b, subject, sender), category in zip(batch, categories):
+                logger.info(f"[email] [{category}] {subject[:50]} | {sender[:30]}")
                 if category == "Promotionnel":
                     report["deleted"] += 1
                     if not dry_run:
@@ -482,11 +553,6 @@ def purge_promotional_emails(host: str, user: str, password: str,
                 else:
                     report["kept"] += 1
 
-            except Exception as e:
-                logger.warning(f"[email] Erreur uid {uid}: {e}")
-                report["errors"] += 1
-                continue
-
         mail.logout()
     except ValueError:
         raise
@@ -570,13 +636,10 @@ class EmailScheduler:
         logger.info("[email-scheduler] Arrêté")
 
     def _get_config(self):
-        """Lit la config email depuis la DB."""
+        """Lit la config email (cache des settings)."""
         try:
-            from database import SessionLocal, Setting
-            db = SessionLocal()
-            settings = {s.key: s.value for s in db.query(Setting).all()}
-            db.close()
-            return settings
+            from database import get_settings_dict
+            return get_settings_dict()
         except Exception:
             return {}
 
@@ -652,10 +715,10 @@ class EmailScheduler:
 
 
 def _trigger_processing(downloaded: list[dict]):
-    """Lance le traitement OCR+LLM pour les fichiers téléchargés."""
+    """Ajoute les fichiers téléchargés à la file de traitement OCR+LLM."""
     try:
         from database import SessionLocal, Document
-        from processor import process_document
+        from services.processing import enqueue_processing
 
         for item in downloaded:
             filepath = item["filepath"]
@@ -674,27 +737,7 @@ def _trigger_processing(downloaded: list[dict]):
             finally:
                 db.close()
 
-            def _process(did, fp):
-                from database import SessionLocal, Document
-                db2 = SessionLocal()
-                try:
-                    text, analysis = process_document(fp)
-                    doc = db2.query(Document).filter(Document.id == did).first()
-                    if doc:
-                        doc.content  = text
-                        doc.category = analysis.get("category")
-                        doc.summary  = analysis.get("summary")
-                        doc.doc_date = analysis.get("date")
-                        doc.amount   = analysis.get("amount")
-                        doc.issuer   = analysis.get("issuer")
-                        db2.commit()
-                        logger.info(f"[email-scheduler] Doc #{did} traité : {analysis.get('category')}")
-                except Exception as e:
-                    logger.error(f"[email-scheduler] Erreur traitement doc {did}: {e}")
-                finally:
-                    db2.close()
-
-            threading.Thread(target=_process, args=(doc_id, filepath), daemon=True).start()
+            enqueue_processing(doc_id, filepath)
 
     except Exception as e:
         logger.error(f"[email-scheduler] Erreur _trigger_processing: {e}")
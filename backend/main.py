@@ -4,8 +4,8 @@ main.py — Point d'entrée de l'application PaperFree-AI.
 Ce fichier initialise l'app FastAPI avec tous les middlewares de sécurité,
 enregistre les routers et démarre les services de fond (watcher, email scheduler).
 """
-import threading
 import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -30,9 +30,19 @@ logger = logging.getLogger(__name__)
 # ---------------------------------------------------------------------------
 # App FastAPI
 # ---------------------------------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from services.processing import start_processing_workers
+    workers = start_processing_workers()
+    yield
+    for task in workers:
+        task.cancel()
+
+
 app = FastAPI(
     title="PaperFree-AI API", 
     version=APP_VERSION,
+    lifespan=lifespan,
     docs_url="/docs",  # Swagger UI
     redoc_url="/redoc"  # ReDoc
 )
@@ -76,7 +86,7 @@ app.include_router(oauth_router)
 # ---------------------------------------------------------------------------
 def _start_background_services():
     from services.watcher import start_folder_watcher
-    threading.Thread(target=start_folder_watcher, daemon=True).start()
+    start_folder_watcher()   # l'observateur watchdog tourne dans son propre thread
     email_monitor.scheduler.start()
     logger.info(f"[app] 🚀 PaperFree-AI v{APP_VERSION} démarré")
 
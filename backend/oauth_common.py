@@ -0,0 +1,171 @@
+"""
+oauth_common.py — Briques communes aux flux OAuth2 IMAP (Microsoft, Google).
+
+Chaque fournisseur (oauth_microsoft.py, oauth_google.py) garde ses endpoints,
+ses scopes et ses clés de settings. Son état en mémoire (PKCE en attente,
+backoff de rafraîchissement) vit dans une instance OAuthProvider, paramétrée par
+le préfixe de ses clés Setting et l'étiquette de ses logs.
+"""
+
+import base64
+import hashlib
+import imaplib
+import logging
+import secrets
+import threading
+import time
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+
+from database import SessionLocal, Setting, get_setting_values, invalidate_settings_cache
+
+logger = logging.getLogger(__name__)
+
+PKCE_TTL = 600      # secondes entre /start et /callback
+_PKCE_MAX = 1024    # flux abandonnés : au-delà, les plus anciens sont évincés
+
+
+class OAuthProvider:
+    """État OAuth d'un fournisseur : clés Setting « <prefix>… », logs « [<tag>] »."""
+
+    def __init__(self, prefix: str, tag: str):
+        self.prefix = prefix
+        self.tag = tag
+        # Stockage temporaire PKCE : state → (code_verifier, timestamp)
+        self._pkce_store: dict[str, tuple[str, float]] = {}
+        self._pkce_lock = threading.Lock()
+        # Un seul rafraîchissement à la fois : les appelants concurrents réutilisent le nouveau token
+        self.refresh_lock = threading.Lock()
+        # Échecs de rafraîchissement : backoff exponentiel (1 min → 1 h), remis à zéro au prochain succès
+        self._refresh_backoff = {"failures": 0, "until": 0.0, "error": ""}
+        self._expiry_memo: tuple[str, float] = ("", 0.0)   # (valeur brute en DB, timestamp parsé)
+
+    # -- PKCE ---------------------------------------------------------------
+
+    def remember_verifier(self, state: str, code_verifier: str):
+        """Mémorise le code_verifier jusqu'au callback."""
+        # Entrées rangées par ancienneté : purge des expirées (> 10 min), puis des plus anciennes si plein
+        now = time.time()
+        with self._pkce_lock:
+            while self._pkce_store and (len(self._pkce_store) >= _PKCE_MAX
+                                        or now - next(iter(self._pkce_store.values()))[1] > PKCE_TTL):
+                del self._pkce_store[next(iter(self._pkce_store))]
+            self._pkce_store[state] = (code_verifier, now)
+
+    def pop_verifier(self, state: str) -> str | None:
+        """code_verifier mémorisé pour state (à usage unique), None si inconnu ou expiré."""
+        with self._pkce_lock:
+            entry = self._pkce_store.pop(state, None)
+        if not entry or time.time() - entry[1] > PKCE_TTL:
+            return None
+        return entry[0]
+
+    # -- Rafraîchissement -----------------------------------------------------
+
+    def check_refresh_backoff(self):
+        """ValueError si un échec récent suspend encore les rafraîchissements."""
+        now = time.time()
+        if now < self._refresh_backoff["until"]:
+            raise ValueError(f"Rafraîchissement suspendu ({int(self._refresh_backoff['until'] - now)} s) "
+                             f"après échec : {self._refresh_backoff['error']}")
+
+    def note_refresh_failure(self, error: Exception):
+        """Évite de marteler l'endpoint token avec un refresh_token révoqué ou un réseau coupé."""
+        delay = min(3600, 60 * 2 ** self._refresh_backoff["failures"])
+        self._refresh_backoff["failures"] += 1
+        self._refresh_backoff["until"] = time.time() + delay
+        self._refresh_backoff["error"] = str(error)
+        logger.warning(f"[{self.tag}] Échec du rafraîchissement, nouvel essai dans {delay} s : {error}")
+
+    def parse_expiry(self, raw: str) -> float:
+        """Timestamp d'expiration stocké en texte → float, parsé une seule fois par valeur."""
+        memo = self._expiry_memo
+        if memo[0] != raw:
+            memo = self._expiry_memo = (raw, float(raw or "0"))
+        return memo[1]
+
+    # -- Persistance ----------------------------------------------------------
+
+    def store_tokens(self, tokens: dict, extra: dict[str, str] | None = None):
+        """
+        Persiste les tokens dans la table Setting (clés préfixées), plus les
+        clés extra telles quelles. Le refresh_token n'est écrit que s'il est
+        fourni : un rafraîchissement qui n'en renvoie pas garde l'ancien.
+        """
+        p = self.prefix
+        to_save = {
+            p + "access_token": tokens.get("access_token", ""),
+            p + "expires_at":   str(time.time() + tokens.get("expires_in", 3600)),
+            p + "token_type":   tokens.get("token_type", "Bearer"),
+            p + "scope":        tokens.get("scope", ""),
+        }
+        if tokens.get("refresh_token"):
+            to_save[p + "refresh_token"] = tokens["refresh_token"]
+        to_save.update(extra or {})
+
+        # Un seul INSERT … ON CONFLICT(key) DO UPDATE pour toutes les clés
+        stmt = sqlite_insert(Setting).values([{"key": k, "value": v} for k, v in to_save.items()])
+        stmt = stmt.on_conflict_do_update(index_elements=["key"], set_={"value": stmt.excluded.value})
+        # Tokens déjà émis par le fournisseur : une écriture perdue forcerait une ré-authentification,
+        # on retente donc une fois avec une session neuve (ex. « database is locked »)
+        for attempt in (1, 2):
+            try:
+                with SessionLocal() as db:
+                    db.execute(stmt)
+                    db.commit()
+                break
+            except OperationalError as e:
+                if attempt == 2:
+                    raise
+                logger.warning(f"[{self.tag}] Écriture des tokens échouée, nouvel essai : {e}")
+        invalidate_settings_cache()   # écriture Core : non vue par les événements ORM
+        self._refresh_backoff.update(failures=0, until=0.0, error="")
+
+
+# ---------------------------------------------------------------------------
+# Helpers PKCE / settings / IMAP
+# ---------------------------------------------------------------------------
+
+def generate_pkce() -> tuple[str, str]:
+    """Retourne (code_verifier, code_challenge)."""
+    # Verifier produit directement en bytes ASCII (86 caractères, comme token_urlsafe(64)) :
+    # le challenge S256 se calcule sur ces bytes, sans aller-retour str → bytes
+    verifier_bytes = base64.urlsafe_b64encode(secrets.token_bytes(64)).rstrip(b"=")
+    digest         = hashlib.sha256(verifier_bytes).digest()
+    code_challenge = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+    return verifier_bytes.decode(), code_challenge
+
+
+def load_setting(key: str) -> str:
+    """Lit une valeur depuis le cache des settings (invalidé au commit de store_tokens)."""
+    try:
+        return get_setting_values(key).get(key) or ""
+    except Exception:
+        return ""
+
+
+def load_settings(*keys: str) -> dict[str, str]:
+    """Lit plusieurs valeurs en une seule lecture du cache ("" si absente)."""
+    try:
+        settings = get_setting_values(*keys)
+    except Exception:
+        settings = {}
+    return {key: settings.get(key) or "" for key in keys}
+
+
+def connect_imap_xoauth2(host: str, user: str, access_token: str, port: int, tag: str):
+    """
+    Connexion IMAP en utilisant XOAUTH2 au lieu de LOGIN basique.
+    Retourne une instance imaplib.IMAP4_SSL authentifiée.
+
+    IMPORTANT : imaplib.authenticate() encode LUI-MÊME la valeur retournée par le
+    callback en base64. Il ne faut donc PAS pré-encoder — on retourne la chaîne brute
+    en bytes (UTF-8), sinon on obtient un double-encodage → "Invalid SASL argument".
+    """
+    auth_bytes = f"user={user}\x01auth=Bearer {access_token}\x01\x01".encode("utf-8")
+
+    mail = imaplib.IMAP4_SSL(host, port)
+    mail.authenticate("XOAUTH2", lambda x: auth_bytes)
+    logger.info(f"[{tag}] Connexion IMAP XOAUTH2 réussie : {user}@{host}")
+    return mail
@@ -16,14 +16,16 @@ Prérequis Google Cloud Console :
   - Scope : https://mail.google.com/
 """
 
-import base64
-import hashlib
 import logging
 import secrets
 import time
 import urllib.parse
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from database import get_setting_values
+from oauth_common import OAuthProvider, generate_pkce, load_setting, load_settings, connect_imap_xoauth2
 
 logger = logging.getLogger(__name__)
 
@@ -38,21 +40,14 @@ SCOPES = [
     "openid",
     "email",                      # Pour récupérer l'adresse email de l'utilisateur
 ]
+_SCOPES_STR = " ".join(SCOPES)
 
-# Stockage temporaire PKCE : state → (code_verifier, timestamp)
-_pkce_store: dict[str, tuple[str, float]] = {}
-
-
-# ---------------------------------------------------------------------------
-# Helpers PKCE
-# ---------------------------------------------------------------------------
+# PKCE en attente, verrou et backoff de rafraîchissement (clés Setting « google_… »)
+_provider = OAuthProvider(prefix="google_", tag="oauth-google")
 
-def _generate_pkce() -> tuple[str, str]:
-    """Retourne (code_verifier, code_challenge)."""
-    code_verifier  = secrets.token_urlsafe(64)
-    digest         = hashlib.sha256(code_verifier.encode()).digest()
-    code_challenge = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
-    return code_verifier, code_challenge
+# Session HTTP partagée : connexion TCP/TLS réutilisée entre échanges et rafraîchissements
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 
 # ---------------------------------------------------------------------------
@@ -62,10 +57,7 @@ def _generate_pkce() -> tuple[str, str]:
 def get_oauth_config() -> dict:
     """Lit google_client_id, google_client_secret et google_redirect_uri depuis la DB."""
     try:
-        from database import SessionLocal, Setting
-        db = SessionLocal()
-        settings = {s.key: s.value for s in db.query(Setting).all()}
-        db.close()
+        settings = get_setting_values("google_client_id", "google_client_secret", "google_redirect_uri")
         return {
             "client_id":     settings.get("google_client_id", ""),
             "client_secret": settings.get("google_client_secret", ""),
@@ -91,20 +83,15 @@ def build_auth_url() -> tuple[str, str]:
         raise ValueError("OAuth2 Google non configuré : google_client_id manquant dans les paramètres.")
 
     state = secrets.token_urlsafe(16)
-    code_verifier, code_challenge = _generate_pkce()
+    code_verifier, code_challenge = generate_pkce()
 
-    # Nettoyer les entrées expirées (> 10 min)
-    now = time.time()
-    expired = [k for k, (_, ts) in _pkce_store.items() if now - ts > 600]
-    for k in expired:
-        del _pkce_store[k]
-    _pkce_store[state] = (code_verifier, now)
+    _provider.remember_verifier(state, code_verifier)   # mémoriser pour le callback
 
     params = {
         "client_id":             cfg["client_id"],
         "response_type":         "code",
         "redirect_uri":          cfg["redirect_uri"],
-        "scope":                 " ".join(SCOPES),
+        "scope":                 _SCOPES_STR,
         "state":                 state,
         "code_challenge":        code_challenge,
         "code_challenge_method": "S256",
@@ -127,10 +114,9 @@ def exchange_code_for_tokens(code: str, state: str) -> dict:
     Stocke les tokens dans la DB.
     """
     cfg = get_oauth_config()
-    entry = _pkce_store.pop(state, None)
-    if not entry:
+    code_verifier = _provider.pop_verifier(state)
+    if code_verifier is None:
         raise ValueError(f"State OAuth invalide ou expiré (> 10 min) : {state}")
-    code_verifier, _ = entry
 
     data = {
         "client_id":     cfg["client_id"],
@@ -141,7 +127,9 @@ def exchange_code_for_tokens(code: str, state: str) -> dict:
         "code_verifier": code_verifier,
     }
 
-    resp = requests.post(TOKEN_ENDPOINT, data=data, timeout=15)
+    # Appels HTTP sans session DB ouverte : la session n'est prise que pour l'upsert final
+    t0 = time.perf_counter()
+    resp = _HTTP.post(TOKEN_ENDPOINT, data=data, timeout=15)
     resp.raise_for_status()
     tokens = resp.json()
 
@@ -150,9 +138,13 @@ def exchange_code_for_tokens(code: str, state: str) -> dict:
 
     # Récupérer l'adresse email de l'utilisateur
     email_user = _fetch_email_user(tokens.get("access_token", ""))
+    t1 = time.perf_counter()
 
     _store_tokens(tokens, email_user)
-    logger.info(f"[oauth-google] Tokens obtenus pour {email_user}")
+    t2 = time.perf_counter()
+    logger.info(f"[oauth-google] Tokens obtenus pour {email_user} "
+                f"(token_exchange_ms={(t1 - t0) * 1000:.0f} db_upsert_ms={(t2 - t1) * 1000:.0f} "
+                f"total_ms={(t2 - t0) * 1000:.0f})")
     return {**tokens, "email_user": email_user}
 
 
@@ -165,8 +157,10 @@ def refresh_access_token() -> str:
     Utilise le refresh_token pour obtenir un nouvel access_token.
     Retourne le nouvel access_token.
     """
+    _provider.check_refresh_backoff()
+
     cfg           = get_oauth_config()
-    refresh_token = _load_setting("google_refresh_token")
+    refresh_token = load_setting("google_refresh_token")
 
     if not refresh_token:
         raise ValueError("Aucun refresh_token Google — re-authentifiez via /email/oauth/google/start")
@@ -178,12 +172,16 @@ def refresh_access_token() -> str:
         "grant_type":    "refresh_token",
     }
 
-    resp = requests.post(TOKEN_ENDPOINT, data=data, timeout=15)
-    resp.raise_for_status()
-    tokens = resp.json()
+    try:
+        resp = _HTTP.post(TOKEN_ENDPOINT, data=data, timeout=15)
+        resp.raise_for_status()
+        tokens = resp.json()
 
-    if "error" in tokens:
-        raise ValueError(f"Refresh token Google invalide : {tokens.get('error_description', tokens['error'])}")
+        if "error" in tokens:
+            raise ValueError(f"Refresh token Google invalide : {tokens.get('error_description', tokens['error'])}")
+    except Exception as e:
+        _provider.note_refresh_failure(e)
+        raise
 
     _store_tokens(tokens)
     logger.info("[oauth-google] Access token rafraîchi")
@@ -199,24 +197,28 @@ def get_valid_access_token() -> tuple[str, str]:
     Retourne (access_token, email_user).
     Rafraîchit automatiquement si expiré ou expire dans < 5 min.
     """
-    access_token = _load_setting("google_access_token")
-    expires_at   = float(_load_setting("google_expires_at") or "0")
-    email_user   = _load_setting("google_email_user") or ""
+    cfg          = load_settings("google_access_token", "google_expires_at", "google_email_user")
+    access_token = cfg["google_access_token"]
+    expires_at   = _provider.parse_expiry(cfg["google_expires_at"])
+    email_user   = cfg["google_email_user"]
 
     now = time.time()
     if not access_token or now >= expires_at - 300:
-        logger.info("[oauth-google] Token expiré → rafraîchissement")
-        access_token = refresh_access_token()
+        with _provider.refresh_lock:
+            # Relecture : un autre thread a peut-être rafraîchi pendant l'attente du verrou
+            cfg = load_settings("google_access_token", "google_expires_at")
+            if cfg["google_access_token"] and time.time() < _provider.parse_expiry(cfg["google_expires_at"]) - 300:
+                return cfg["google_access_token"], email_user
+            logger.info("[oauth-google] Token expiré → rafraîchissement")
+            access_token = refresh_access_token()
 
     return access_token, email_user
 
 
 def is_oauth_configured() -> bool:
     """Vérifie si OAuth2 Google est configuré et qu'un refresh_token est disponible."""
-    return bool(
-        _load_setting("google_client_id") and
-        _load_setting("google_refresh_token")
-    )
+    cfg = load_settings("google_client_id", "google_refresh_token")
+    return bool(cfg["google_client_id"] and cfg["google_refresh_token"])
 
 
 # ---------------------------------------------------------------------------
@@ -224,23 +226,8 @@ def is_oauth_configured() -> bool:
 # ---------------------------------------------------------------------------
 
 def connect_imap_oauth(host: str, user: str, access_token: str, port: int = 993):
-    """
-    Connexion IMAP Gmail en XOAUTH2.
-    Retourne une instance imaplib.IMAP4_SSL authentifiée.
-
-    IMPORTANT : imaplib.authenticate() encode LUI-MÊME la valeur retournée par le
-    callback en base64. Il ne faut donc PAS pré-encoder — on retourne la chaîne brute
-    en bytes (UTF-8), sinon on obtient un double-encodage → "Invalid SASL argument".
-    """
-    import imaplib
-
-    auth_string = f"user={user}\x01auth=Bearer {access_token}\x01\x01"
-    auth_bytes  = auth_string.encode("utf-8")   # brut, PAS base64
-
-    mail = imaplib.IMAP4_SSL(host, port)
-    mail.authenticate("XOAUTH2", lambda x: auth_bytes)
-    logger.info(f"[oauth-google] Connexion IMAP XOAUTH2 réussie : {user}@{host}")
-    return mail
+    """Connexion IMAP en XOAUTH2 ; retourne une instance imaplib.IMAP4_SSL authentifiée."""
+    return connect_imap_xoauth2(host, user, access_token, port, tag="oauth-google")
 
 
 # ---------------------------------------------------------------------------
@@ -250,7 +237,7 @@ def connect_imap_oauth(host: str, user: str, access_token: str, port: int = 993)
 def _fetch_email_user(access_token: str) -> str:
     """Récupère l'adresse email Google via l'API userinfo."""
     try:
-        resp = requests.get(
+        resp = _HTTP.get(
             "https://www.googleapis.com/oauth2/v2/userinfo",
             headers={"Authorization": f"Bearer {access_token}"},
             timeout=10,
@@ -263,42 +250,7 @@ def _fetch_email_user(access_token: str) -> str:
 
 
 def _store_tokens(tokens: dict, email_user: str = ""):
-    """Persiste les tokens OAuth Google dans la table Setting."""
-    from database import SessionLocal, Setting
-
-    expires_at = str(time.time() + tokens.get("expires_in", 3600))
-    to_save = {
-        "google_access_token":  tokens.get("access_token", ""),
-        "google_expires_at":    expires_at,
-        "google_token_type":    tokens.get("token_type", "Bearer"),
-        "google_scope":         tokens.get("scope", ""),
-    }
-    # Le refresh_token n'est fourni qu'à la première autorisation (prompt=consent)
-    if tokens.get("refresh_token"):
-        to_save["google_refresh_token"] = tokens["refresh_token"]
-    if email_user:
-        to_save["google_email_user"] = email_user
-
-    db = SessionLocal()
-    try:
-        for key, value in to_save.items():
-            setting = db.query(Setting).filter(Setting.key == key).first()
-            if setting:
-                setting.value = value
-            else:
-                db.add(Setting(key=key, value=value))
-        db.commit()
-    finally:
-        db.close()
-
-
-def _load_setting(key: str) -> str:
-    """Lit une valeur depuis la table Setting."""
-    try:
-        from database import SessionLocal, Setting
-        db = SessionLocal()
-        row = db.query(Setting).filter(Setting.key == key).first()
-        db.close()
-        return row.value if row else ""
-    except Exception:
-        return ""
+    """Persiste les tokens OAuth Google dans la table Setting (clés google_*)."""
+    # Le refresh_token n'est fourni qu'à la première autorisation (prompt=consent) :
+    # store_tokens ne l'écrase pas quand un rafraîchissement n'en renvoie pas
+    _provider.store_tokens(tokens, {"google_email_user": email_user} if email_user else None)
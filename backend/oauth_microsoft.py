@@ -14,17 +14,16 @@ Prérequis Azure :
   - Scopes : https://outlook.office.com/IMAP.AccessAsUser.All offline_access
 """
 
-import base64
-import hashlib
-import json
 import logging
-import os
 import secrets
 import time
 import urllib.parse
-from datetime import datetime, timezone
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from database import get_setting_values
+from oauth_common import OAuthProvider, generate_pkce, load_setting, load_settings, connect_imap_xoauth2
 
 logger = logging.getLogger(__name__)
 
@@ -41,22 +40,14 @@ SCOPES = [
     "https://outlook.office.com/IMAP.AccessAsUser.All",
     "offline_access",   # nécessaire pour obtenir le refresh_token
 ]
+_SCOPES_STR = " ".join(SCOPES)
 
-# Stockage temporaire du code_verifier PKCE entre /start et /callback
-# TTL de 10 min pour éviter les fuites mémoire
-_pkce_store: dict[str, tuple[str, float]] = {}   # state → (code_verifier, timestamp)
-
-
-# ---------------------------------------------------------------------------
-# Helpers PKCE
-# ---------------------------------------------------------------------------
+# PKCE en attente, verrou et backoff de rafraîchissement (clés Setting « oauth_… »)
+_provider = OAuthProvider(prefix="oauth_", tag="oauth")
 
-def _generate_pkce() -> tuple[str, str]:
-    """Retourne (code_verifier, code_challenge)."""
-    code_verifier  = secrets.token_urlsafe(64)
-    digest         = hashlib.sha256(code_verifier.encode()).digest()
-    code_challenge = base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
-    return code_verifier, code_challenge
+# Session HTTP partagée : connexion TCP/TLS réutilisée entre échanges et rafraîchissements
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 
 # ---------------------------------------------------------------------------
@@ -66,10 +57,7 @@ def _generate_pkce() -> tuple[str, str]:
 def get_oauth_config() -> dict:
     """Lit client_id, client_secret et redirect_uri depuis la DB."""
     try:
-        from database import SessionLocal, Setting
-        db = SessionLocal()
-        settings = {s.key: s.value for s in db.query(Setting).all()}
-        db.close()
+        settings = get_setting_values("oauth_client_id", "oauth_client_secret", "oauth_redirect_uri")
         return {
             "client_id":     settings.get("oauth_client_id", ""),
             "client_secret": settings.get("oauth_client_secret", ""),
@@ -95,20 +83,15 @@ def build_auth_url() -> tuple[str, str]:
         raise ValueError("OAuth2 non configuré : client_id manquant dans les paramètres.")
 
     state          = secrets.token_urlsafe(16)
-    code_verifier, code_challenge = _generate_pkce()
-    # Nettoyer les entrées expirées (> 10 min)
-    now = time.time()
-    expired = [k for k, (_, ts) in _pkce_store.items() if now - ts > 600]
-    for k in expired:
-        del _pkce_store[k]
-    _pkce_store[state] = (code_verifier, now)  # mémoriser pour le callback
+    code_verifier, code_challenge = generate_pkce()
+    _provider.remember_verifier(state, code_verifier)   # mémoriser pour le callback
 
     params = {
         "client_id":             cfg["client_id"],
         "response_type":         "code",
         "redirect_uri":          cfg["redirect_uri"],
         "response_mode":         "query",
-        "scope":                 " ".join(SCOPES),
+        "scope":                 _SCOPES_STR,
         "state":                 state,
         "code_challenge":        code_challenge,
         "code_challenge_method": "S256",
@@ -129,10 +112,9 @@ def exchange_code_for_tokens(code: str, state: str) -> dict:
     Retourne le dict de tokens.
     """
     cfg = get_oauth_config()
-    entry = _pkce_store.pop(state, None)
-    if not entry:
+    code_verifier = _provider.pop_verifier(state)
+    if code_verifier is None:
         raise ValueError(f"State OAuth invalide ou expiré (> 10 min) : {state}")
-    code_verifier, _ = entry
 
     data = {
         "client_id":     cfg["client_id"],
@@ -141,18 +123,24 @@ def exchange_code_for_tokens(code: str, state: str) -> dict:
         "redirect_uri":  cfg["redirect_uri"],
         "grant_type":    "authorization_code",
         "code_verifier": code_verifier,
-        "scope":         " ".join(SCOPES),
+        "scope":         _SCOPES_STR,
     }
 
-    resp = requests.post(TOKEN_ENDPOINT, data=data, timeout=15)
+    # Appel HTTP sans session DB ouverte : la session n'est prise que pour l'upsert final
+    t0 = time.perf_counter()
+    resp = _HTTP.post(TOKEN_ENDPOINT, data=data, timeout=15)
     resp.raise_for_status()
     tokens = resp.json()
 
     if "error" in tokens:
         raise ValueError(f"Erreur token Microsoft : {tokens.get('error_description', tokens['error'])}")
+    t1 = time.perf_counter()
 
     _store_tokens(tokens)
-    logger.info("[oauth] Tokens obtenus et stockés avec succès")
+    t2 = time.perf_counter()
+    logger.info(f"[oauth] Tokens obtenus et stockés avec succès "
+                f"(token_exchange_ms={(t1 - t0) * 1000:.0f} db_upsert_ms={(t2 - t1) * 1000:.0f} "
+                f"total_ms={(t2 - t0) * 1000:.0f})")
     return tokens
 
 
@@ -165,8 +153,10 @@ def refresh_access_token() -> str:
     Utilise le refresh_token pour obtenir un nouvel access_token.
     Retourne le nouvel access_token.
     """
+    _provider.check_refresh_backoff()
+
     cfg           = get_oauth_config()
-    refresh_token = _load_setting("oauth_refresh_token")
+    refresh_token = load_setting("oauth_refresh_token")
 
     if not refresh_token:
         raise ValueError("Aucun refresh_token stocké — re-authentifiez via /email/oauth/start")
@@ -176,15 +166,19 @@ def refresh_access_token() -> str:
         "client_secret": cfg["client_secret"],
         "refresh_token": refresh_token,
         "grant_type":    "refresh_token",
-        "scope":         " ".join(SCOPES),
+        "scope":         _SCOPES_STR,
     }
 
-    resp = requests.post(TOKEN_ENDPOINT, data=data, timeout=15)
-    resp.raise_for_status()
-    tokens = resp.json()
+    try:
+        resp = _HTTP.post(TOKEN_ENDPOINT, data=data, timeout=15)
+        resp.raise_for_status()
+        tokens = resp.json()
 
-    if "error" in tokens:
-        raise ValueError(f"Refresh token invalide : {tokens.get('error_description', tokens['error'])}")
+        if "error" in tokens:
+            raise ValueError(f"Refresh token invalide : {tokens.get('error_description', tokens['error'])}")
+    except Exception as e:
+        _provider.note_refresh_failure(e)
+        raise
 
     _store_tokens(tokens)
     logger.info("[oauth] Access token rafraîchi")
@@ -200,24 +194,28 @@ def get_valid_access_token() -> tuple[str, str]:
     Retourne (access_token, email_user) prêts à l'emploi.
     Rafraîchit automatiquement si le token est expiré ou expire dans < 5 min.
     """
-    access_token = _load_setting("oauth_access_token")
-    expires_at   = float(_load_setting("oauth_expires_at") or "0")
-    email_user   = _load_setting("email_user") or ""
+    cfg          = load_settings("oauth_access_token", "oauth_expires_at", "email_user")
+    access_token = cfg["oauth_access_token"]
+    expires_at   = _provider.parse_expiry(cfg["oauth_expires_at"])
+    email_user   = cfg["email_user"]
 
     now = time.time()
     if not access_token or now >= expires_at - 300:
-        logger.info("[oauth] Token expiré ou absent → rafraîchissement")
-        access_token = refresh_access_token()
+        with _provider.refresh_lock:
+            # Relecture : un autre thread a peut-être rafraîchi pendant l'attente du verrou
+            cfg = load_settings("oauth_access_token", "oauth_expires_at")
+            if cfg["oauth_access_token"] and time.time() < _provider.parse_expiry(cfg["oauth_expires_at"]) - 300:
+                return cfg["oauth_access_token"], email_user
+            logger.info("[oauth] Token expiré ou absent → rafraîchissement")
+            access_token = refresh_access_token()
 
     return access_token, email_user
 
 
 def is_oauth_configured() -> bool:
     """Vérifie si OAuth2 est configuré et qu'un refresh_token est disponible."""
-    return bool(
-        _load_setting("oauth_client_id") and
-        _load_setting("oauth_refresh_token")
-    )
+    cfg = load_settings("oauth_client_id", "oauth_refresh_token")
+    return bool(cfg["oauth_client_id"] and cfg["oauth_refresh_token"])
 
 
 # ---------------------------------------------------------------------------
@@ -225,23 +223,8 @@ def is_oauth_configured() -> bool:
 # ---------------------------------------------------------------------------
 
 def connect_imap_oauth(host: str, user: str, access_token: str, port: int = 993):
-    """
-    Connexion IMAP en utilisant XOAUTH2 au lieu de LOGIN basique.
-    Retourne une instance imaplib.IMAP4_SSL authentifiée.
-
-    IMPORTANT : imaplib.authenticate() encode LUI-MÊME la valeur retournée par le
-    callback en base64. Il ne faut donc PAS pré-encoder — on retourne la chaîne brute
-    en bytes (UTF-8), sinon on obtient un double-encodage → "Invalid SASL argument".
-    """
-    import imaplib
-
-    auth_string = f"user={user}\x01auth=Bearer {access_token}\x01\x01"
-    auth_bytes  = auth_string.encode("utf-8")   # brut, PAS base64
-
-    mail = imaplib.IMAP4_SSL(host, port)
-    mail.authenticate("XOAUTH2", lambda x: auth_bytes)
-    logger.info(f"[oauth] Connexion IMAP XOAUTH2 réussie : {user}@{host}")
-    return mail
+    """Connexion IMAP en XOAUTH2 ; retourne une instance imaplib.IMAP4_SSL authentifiée."""
+    return connect_imap_xoauth2(host, user, access_token, port, tag="oauth")
 
 
 # ---------------------------------------------------------------------------
@@ -249,37 +232,5 @@ def connect_imap_oauth(host: str, user: str, access_token: str, port: int = 993)
 # ---------------------------------------------------------------------------
 
 def _store_tokens(tokens: dict):
-    """Persiste les tokens OAuth dans la table Setting."""
-    from database import SessionLocal, Setting
-
-    expires_at = str(time.time() + tokens.get("expires_in", 3600))
-    to_save = {
-        "oauth_access_token":  tokens.get("access_token", ""),
-        "oauth_refresh_token": tokens.get("refresh_token", ""),
-        "oauth_expires_at":    expires_at,
-        "oauth_token_type":    tokens.get("token_type", "Bearer"),
-        "oauth_scope":         tokens.get("scope", ""),
-    }
-    db = SessionLocal()
-    try:
-        for key, value in to_save.items():
-            setting = db.query(Setting).filter(Setting.key == key).first()
-            if setting:
-                setting.value = value
-            else:
-                db.add(Setting(key=key, value=value))
-        db.commit()
-    finally:
-        db.close()
-
-
-def _load_setting(key: str) -> str:
-    """Lit une valeur depuis la table Setting."""
-    try:
-        from database import SessionLocal, Setting
-        db = SessionLocal()
-        row = db.query(Setting).filter(Setting.key == key).first()
-        db.close()
-        return row.value if row else ""
-    except Exception:
-        return ""
+    """Persiste les tokens OAuth dans la table Setting (clés oauth_*)."""
+    _provider.store_tokens(tokens)
@@ -1,27 +1,51 @@
+import io
 import os
+import html
 import json
+import hashlib
+import importlib.util
+import datetime
+import threading
 import base64
 import logging
 import subprocess
 import tempfile
 import shutil
+import queue
 import concurrent.futures
+import contextvars
+from collections import Counter, OrderedDict
+from functools import lru_cache
 import pytesseract
-from PIL import Image
+from PIL import Image, ImageOps
 from enhance import enhance_image
 import PyPDF2
-from openai import OpenAI
+from openai import OpenAI, BadRequestError
 from dotenv import load_dotenv
 from prompts import (
     SYSTEM_PROMPT,
     OCR_CORRECTION_PROMPT,
+    OCR_CORRECT_AND_ANALYZE_PROMPT,
     OCR_VISION_FUSION_PROMPT,
+    OCR_VISION_FUSION_INPUT,
     VISION_SYSTEM_PROMPT,
 )
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Extensions traitées comme des images (prétraitement, OCR, PDF searchable)
+IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".webp"})
+
+# Un thread OpenMP par processus Tesseract : plusieurs processus mono-thread en
+# parallèle vont plus vite qu'un seul qui se dispute les cœurs avec les autres
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+# Reconnaissances Tesseract simultanées (tous documents confondus) limitées au
+# nombre de cœurs : PROCESSING_CONCURRENCY peut dépasser ce nombre pour que des
+# documents attendent le LLM pendant que d'autres passent l'OCR, sans surcharger
+# le CPU. Les appels LLM (réseau) ne sont pas concernés.
+_ocr_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
 # Valeurs par défaut lues depuis .env, avec fallback sur la DB si besoin
 DEFAULT_LLM_CONFIG = {
     "base_url": os.getenv("LLM_BASE_URL", "http://localhost:1234/v1"),
@@ -45,13 +69,21 @@ GEMINI_MODELS = [
     "gemini-1.5-pro",
 ]
 
+# Fallback PDF scanné : nombre maximal de pages OCRisées
+_PDF_OCR_MAX_PAGES = 20
+
+_LLM_CONFIG_KEYS = (
+    "llm_base_url", "llm_api_key", "llm_model",
+    "llm_vision_enabled", "llm_vision_provider", "llm_vision_model",
+    "llm_vision_api_key", "llm_vision_base_url",
+    "ocr_llm_correction", "ocr_correction_threshold", "ocr_vision_fusion",
+)
+
 def get_llm_config() -> dict:
-    """Lit la config LLM depuis la DB, avec fallback sur les variables d'env."""
+    """Lit la config LLM depuis le cache des settings, avec fallback sur les variables d'env."""
     try:
-        from database import SessionLocal, Setting
-        db = SessionLocal()
-        settings = {s.key: s.value for s in db.query(Setting).all()}
-        db.close()
+        from database import get_setting_values
+        settings = get_setting_values(*_LLM_CONFIG_KEYS)
         return {
             "base_url":        settings.get("llm_base_url")        or DEFAULT_LLM_CONFIG["base_url"],
             "api_key":         settings.get("llm_api_key")         or DEFAULT_LLM_CONFIG["api_key"],
@@ -85,17 +117,25 @@ def generate_text_pdf(
     base_name: str,
     meta: dict | None = None,
     image_path: str | None = None,
+    image_enhanced: bool = False,
 ) -> str | None:
+    """
+    PDF searchable de l'image (image_path) si elle existe, sinon PDF texte.
+    image_enhanced : image_path est déjà passée par enhance_image (celle
+    produite pour l'OCR du document), elle n'est pas retraitée.
+    """
     if image_path and os.path.exists(image_path):
-        return _generate_searchable_pdf(image_path, output_dir, base_name)
+        return _generate_searchable_pdf(image_path, output_dir, base_name, image_enhanced)
     return _generate_text_only_pdf(text, output_dir, base_name, meta)
 
 
-def _generate_searchable_pdf(image_path: str, output_dir: str, base_name: str) -> str | None:
+def _generate_searchable_pdf(
+    image_path: str, output_dir: str, base_name: str, image_enhanced: bool = False,
+) -> str | None:
     try:
-        enhanced_path = enhance_image(image_path, output_dir=None)
+        enhanced_path = image_path if image_enhanced else enhance_image(image_path, output_dir=None)
         cleanup_enhanced = (enhanced_path != image_path)
-        with tempfile.TemporaryDirectory() as tmp:
+        with tempfile.TemporaryDirectory() as tmp, _ocr_slots:
             tmp_base = os.path.join(tmp, "out")
             subprocess.run(
                 ["tesseract", enhanced_path, tmp_base, "-l", "fra+eng", "--dpi", "300", "pdf"],
@@ -118,12 +158,24 @@ def _generate_searchable_pdf(image_path: str, output_dir: str, base_name: str) -
         return None
 
 
+@lru_cache(maxsize=1)
+def _pdf_text_styles():
+    """Feuille de styles reportlab et style du corps de texte, construits une seule fois."""
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib import colors
+
+    styles = getSampleStyleSheet()
+    body = ParagraphStyle("Body", parent=styles["Normal"],
+                          fontSize=10, leading=15,
+                          textColor=colors.HexColor("#1f2937"), spaceAfter=6)
+    return styles, body
+
+
 def _generate_text_only_pdf(
     text: str, output_dir: str, base_name: str, meta: dict | None
 ) -> str | None:
     try:
         from reportlab.lib.pagesizes import A4
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
         from reportlab.lib.units import cm
         from reportlab.lib import colors
         from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable
@@ -133,10 +185,7 @@ def _generate_text_only_pdf(
         doc = SimpleDocTemplate(pdf_path, pagesize=A4,
                                 leftMargin=2.5*cm, rightMargin=2.5*cm,
                                 topMargin=2.5*cm, bottomMargin=2.5*cm)
-        styles = getSampleStyleSheet()
-        body = ParagraphStyle("Body", parent=styles["Normal"],
-                              fontSize=10, leading=15,
-                              textColor=colors.HexColor("#1f2937"), spaceAfter=6)
+        styles, body = _pdf_text_styles()
         story = []
         if meta.get("category"):
             story.append(Paragraph(meta["category"], styles["Heading1"]))
@@ -145,8 +194,9 @@ def _generate_text_only_pdf(
             story.append(Spacer(1, 0.4*cm))
         story.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor("#e5e7eb")))
         story.append(Spacer(1, 0.3*cm))
-        for line in (text or "").splitlines():
-            safe = line.strip().replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+        # Échappement en une passe sur tout le texte plutôt que trois replace par ligne
+        for line in html.escape(text or "", quote=False).splitlines():
+            safe = line.strip()
             story.append(Paragraph(safe, body) if safe else Spacer(1, 0.2*cm))
         doc.build(story)
         logger.info(f"[pdf-text] PDF texte généré : {pdf_path}")
@@ -160,30 +210,259 @@ def _generate_text_only_pdf(
 # OCR avec score de confiance
 # ---------------------------------------------------------------------------
 
-def extract_text_with_confidence(file_path: str) -> tuple[str, float]:
-    if file_path.lower().endswith(".pdf"):
+def extract_text_with_confidence(file_path: str, ext: str | None = None) -> tuple[str, float]:
+    """OCR d'un fichier image (texte natif pour un PDF). ext : extension en minuscules, si déjà connue."""
+    if ext is None:
+        ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".pdf":
         return _extract_pdf_text(file_path), 100.0
     try:
         img = Image.open(file_path)
-        data = pytesseract.image_to_data(img, lang="fra+eng", output_type=pytesseract.Output.DICT)
-        confidences = [int(c) for c in data["conf"] if int(c) >= 0]
+        img.load()  # décodage unique avant le partage entre threads
+    except Exception as e:
+        logger.error(f"[ocr] Erreur Tesseract : {e}")
+        return "", 0.0
+    return _ocr_image(img)
+
+
+def _ocr_image(img) -> tuple[str, float]:
+    """OCR d'une image déjà en mémoire (PIL ou tableau numpy RGB)."""
+    img = _prepare_for_ocr(img)
+    if img is None:
+        logger.info("[ocr] Image uniforme (page vide ?) — OCR ignoré")
+        return "", 0.0
+    # L'instance tesserocr est empruntée une fois le créneau obtenu : il n'en
+    # existe jamais plus que de créneaux, même lors d'un afflux de pages
+    with _ocr_slots:
+        api = _acquire_tess_api()
+        if api is not None:
+            return _ocr_image_tesserocr(api, img)
+        try:
+            # Un seul passage : le texte est reconstruit depuis les mots de image_to_data
+            tsv = pytesseract.image_to_data(img, lang="fra+eng")
+        except Exception as e:
+            logger.error(f"[ocr] Erreur Tesseract : {e}")
+            return "", 0.0
+    try:
+        text, avg_conf, n_words = _pages_from_ocr_data(tsv)[0]
+    except Exception as e:
+        logger.error(f"[ocr] Erreur Tesseract : {e}")
+        return "", 0.0
+    logger.info(f"[ocr] Confiance moyenne : {avg_conf:.1f}% ({n_words} mots)")
+    return text, avg_conf
+
+
+def _pages_from_ocr_data(tsv: str, n_pages: int = 1) -> list[tuple[str, float, int]]:
+    """
+    (texte, confiance moyenne, nombre de mots) de chaque page d'une sortie TSV
+    d'image_to_data : mots d'une ligne séparés par une espace, lignes par un
+    saut de ligne, paragraphes par une ligne vide (comme image_to_string).
+    Le TSV est lu directement (seules les colonnes utiles sont converties)
+    plutôt que via Output.DICT, qui convertit les 12 colonnes de chaque ligne.
+    """
+    import numpy as np
+
+    # Colonnes : level page_num block_num par_num line_num word_num
+    #            left top width height conf text
+    rows = [row for row in (line.split("\t") for line in tsv.splitlines()[1:]) if len(row) >= 11]
+
+    # Confiances : somme et effectif par page en une passe vectorisée
+    # (conf = -1 pour les blocs/lignes, qui ne sont pas des mots)
+    page_nums = np.array([row[1] for row in rows], dtype=np.int32)
+    confs = np.array([row[10] for row in rows], dtype=np.float32)
+    mask = (confs >= 0) & (page_nums >= 1) & (page_nums <= n_pages)
+    conf_sums = np.bincount(page_nums[mask] - 1, weights=confs[mask], minlength=n_pages)
+    conf_counts = np.bincount(page_nums[mask] - 1, minlength=n_pages)
+
+    lines: list[list[list[str] | None]] = [[] for _ in range(n_pages)]
+    last_line: list[tuple | None] = [None] * n_pages
+    for row in rows:
+        if len(row) < 12 or not row[11].strip():
+            continue
+        page = int(row[1])
+        if not 1 <= page <= n_pages:
+            continue
+        p = page - 1
+        key = (row[2], row[3], row[4])
+        if key != last_line[p]:
+            previous = last_line[p]
+            if previous is not None and previous[:2] != key[:2]:
+                lines[p].append(None)  # nouveau paragraphe
+            lines[p].append([])
+            last_line[p] = key
+        lines[p][-1].append(row[11])
+
+    pages = []
+    for page_lines, total, count in zip(lines, conf_sums.tolist(), conf_counts.tolist()):
+        text = "\n".join("" if words is None else " ".join(words) for words in page_lines)
+        pages.append((text, total / count if count else 0.0, count))
+    return pages
+
+
+# Écart de niveaux de gris (image réduite) en dessous duquel il n'y a rien à lire
+_BLANK_MAX_CONTRAST = 30
+
+
+def _looks_blank(img) -> bool:
+    """
+    Test rapide avant de lancer Tesseract : page vide, photo noire ou surexposée.
+    L'image est d'abord réduite (moyenne de zones) pour que le grain ne compte
+    pas ; une seule ligne de texte suffit à dépasser le seuil.
+    """
+    try:
+        import cv2
+        import numpy as np
+        if isinstance(img, Image.Image):
+            gray = np.asarray(img.convert("L"))
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+        scale = min(1.0, 512 / max(gray.shape[:2]))
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        low, high, _, _ = cv2.minMaxLoc(gray)
+        return high - low < _BLANK_MAX_CONTRAST
+    except Exception:
+        return False
+
+
+# Plus grand côté envoyé à Tesseract (~200 dpi pour une page A4)
+_OCR_MAX_SIDE = 2500
+
+
+def _prepare_for_ocr(img) -> "Image.Image | None":
+    """
+    Niveau de gris, réduction à _OCR_MAX_SIDE et binarisation d'Otsu avant
+    Tesseract : moins de pixels à transmettre (PNG noir et blanc) et à analyser.
+    Retourne None si l'image semble vide (voir _looks_blank).
+    En cas d'erreur, l'image est rendue telle quelle.
+    """
+    try:
+        import cv2
+        import numpy as np
+        if isinstance(img, Image.Image):
+            gray = np.asarray(img.convert("L"))
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+    except Exception as e:
+        logger.debug(f"[ocr] Prétraitement ignoré : {e}")
+        return img if not _looks_blank(img) else None
+
+    if _looks_blank(gray):
+        return None
+    scale = _OCR_MAX_SIDE / max(gray.shape[:2])
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return Image.fromarray(binary)
+
+
+# Instances tesserocr libres (modèle déjà chargé), réutilisées d'un appel à l'autre.
+# Une instance n'est pas thread-safe : chaque OCR en cours en emprunte une, en
+# tenant un créneau _ocr_slots, et la rend avant de le libérer.
+_tess_pool: "queue.SimpleQueue" = queue.SimpleQueue()
+_tess_init_lock = threading.Lock()
+
+
+def _tesserocr():
+    """Module tesserocr s'il est installé et utilisable (optionnel), sinon None → pytesseract."""
+    with _tess_init_lock:
+        return _load_tesserocr()
+
+
+@lru_cache(maxsize=1)
+def _load_tesserocr():
+    try:
+        import tesserocr
+    except ImportError:
+        return None
+    try:
+        # Première instance construite ici, une seule fois : une installation
+        # inutilisable (modèle fra+eng absent…) n'est signalée qu'une fois
+        _tess_pool.put(tesserocr.PyTessBaseAPI(lang="fra+eng"))
+    except Exception as e:
+        logger.warning(f"[ocr] tesserocr indisponible, repli sur pytesseract : {e}")
+        return None
+    return tesserocr
+
+
+def _acquire_tess_api():
+    """Instance tesserocr libre, créée si toutes sont prises (appelant dans _ocr_slots)."""
+    tesserocr = _tesserocr()
+    if tesserocr is None:
+        return None
+    try:
+        return _tess_pool.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return tesserocr.PyTessBaseAPI(lang="fra+eng")
+    except Exception as e:
+        logger.error(f"[ocr] Instance tesserocr non créée : {e}")
+        return None
+
+
+def _ocr_image_tesserocr(api, img) -> tuple[str, float]:
+    """OCR en processus : texte et confiances d'une seule reconnaissance."""
+    try:
+        if not isinstance(img, Image.Image):
+            img = Image.fromarray(img)
+        api.SetImage(img)
+        text = api.GetUTF8Text().strip()
+        confidences = api.AllWordConfidences()
         avg_conf = sum(confidences) / len(confidences) if confidences else 0.0
-        text = pytesseract.image_to_string(img, lang="fra+eng").strip()
         logger.info(f"[ocr] Confiance moyenne : {avg_conf:.1f}% ({len(confidences)} mots)")
         return text, avg_conf
     except Exception as e:
         logger.error(f"[ocr] Erreur Tesseract : {e}")
         return "", 0.0
+    finally:
+        api.Clear()
+        _tess_pool.put(api)
+
 
 def _extract_pdf_text(file_path: str) -> str:
-    text = ""
+    """
+    Texte natif d'un PDF. PyMuPDF (extraction en code natif, bien plus rapide)
+    si disponible, sinon PyPDF2 (pur Python).
+    """
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        return _extract_pdf_text_pypdf2(file_path)
+    try:
+        with fitz.open(file_path) as doc:
+            return "\n".join(page.get_text() for page in doc).strip()
+    except Exception as e:
+        logger.warning(f"[pdf-text] PyMuPDF échoué, repli sur PyPDF2 : {e}")
+        return _extract_pdf_text_pypdf2(file_path)
+
+
+def _pdf_page_count(file_path: str) -> int:
+    """Nombre de pages (PyMuPDF si disponible, sinon PyPDF2) ; 1 si illisible."""
+    try:
+        import fitz  # PyMuPDF
+        with fitz.open(file_path) as doc:
+            return max(1, doc.page_count)
+    except ImportError:
+        pass
+    except Exception:
+        return 1
+    try:
+        with open(file_path, "rb") as f:
+            return max(1, len(PyPDF2.PdfReader(f).pages))
+    except Exception:
+        return 1
+
+
+def _extract_pdf_text_pypdf2(file_path: str) -> str:
+    parts = []
     with open(file_path, "rb") as f:
         reader = PyPDF2.PdfReader(f)
         for page in reader.pages:
             page_text = page.extract_text()
             if page_text:
-                text += page_text + "\n"
-    return text.strip()
+                parts.append(page_text)
+    return "\n".join(parts).strip()
 
 
 def _pdf_page_to_image(file_path: str, page: int = 0) -> str | None:
@@ -192,17 +471,30 @@ def _pdf_page_to_image(file_path: str, page: int = 0) -> str | None:
     Utilise pdf2image (poppler) si disponible, sinon tente PyMuPDF (fitz).
     Retourne le chemin de l'image temporaire, ou None en cas d'échec.
     """
-    tmp_path = None
+    image = _render_pdf_page(file_path, page)
+    if image is None:
+        return None
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+    tmp_path = tmp.name
+    tmp.close()
+    image.save(tmp_path, "PNG")
+    return tmp_path
+
+
+def _render_pdf_page(file_path: str, page: int):
+    """
+    Rend une page d'un PDF en mémoire à 200 dpi : image PIL via pdf2image, ou
+    tableau numpy RGB posé sur les octets du pixmap PyMuPDF.
+    Retourne None en cas d'échec.
+    """
     try:
         from pdf2image import convert_from_path
         images = convert_from_path(file_path, first_page=page + 1, last_page=page + 1, dpi=200)
         if images:
-            tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-            tmp_path = tmp.name
-            tmp.close()
-            images[0].save(tmp_path, "PNG")
-            logger.info(f"[pdf→img] Page {page} extraite via pdf2image : {tmp_path}")
-            return tmp_path
+            logger.info(f"[pdf→img] Page {page} extraite via pdf2image")
+            return images[0]
     except ImportError:
         pass
     except Exception as e:
@@ -210,14 +502,14 @@ def _pdf_page_to_image(file_path: str, page: int = 0) -> str | None:
 
     try:
         import fitz  # PyMuPDF
-        doc = fitz.open(file_path)
-        pix = doc[page].get_pixmap(dpi=200)
-        tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-        tmp_path = tmp.name
-        tmp.close()
-        pix.save(tmp_path)
-        logger.info(f"[pdf→img] Page {page} extraite via PyMuPDF : {tmp_path}")
-        return tmp_path
+        import numpy as np
+        with fitz.open(file_path) as doc:
+            pix = doc[page].get_pixmap(dpi=200, alpha=False)
+        # Vue numpy sur les octets du pixmap : aucune copie supplémentaire
+        # (samples_mv serait invalide une fois le pixmap libéré)
+        array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        logger.info(f"[pdf→img] Page {page} extraite via PyMuPDF")
+        return array
     except ImportError:
         logger.warning("[pdf→img] Ni pdf2image ni PyMuPDF disponibles — fallback PDF scanné impossible")
     except Exception as e:
@@ -226,6 +518,168 @@ def _pdf_page_to_image(file_path: str, page: int = 0) -> str | None:
     return None
 
 
+def _ocr_pdf_page(file_path: str, page: int) -> tuple[str, float]:
+    """Rend une page du PDF en mémoire et l'OCRise (sans passer par un PNG)."""
+    image = _render_pdf_page(file_path, page)
+    if image is None:
+        return "", 0.0
+    return _ocr_image(image)
+
+
+def _ocr_pdf_pages(file_path: str, first_page_image: str) -> tuple[str, float]:
+    """
+    OCR des pages d'un PDF scanné (au plus _PDF_OCR_MAX_PAGES), la page 1 étant
+    déjà rendue par l'appelant. Rendu (poppler) et Tesseract sont des
+    sous-processus : un pool de threads suffit à occuper tous les cœurs.
+    Retourne (texte des pages dans l'ordre, confiance moyenne).
+    """
+    n_pages = min(_pdf_page_count(file_path), _PDF_OCR_MAX_PAGES)
+    workers = min(os.cpu_count() or 1, n_pages)
+
+    if n_pages > workers and _tesserocr() is None:
+        # Plus de pages que de cœurs : un processus tesseract par lot de pages
+        # plutôt qu'un (et un chargement du modèle) par page
+        results = _ocr_pdf_pages_batched(file_path, first_page_image, n_pages, workers)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(extract_text_with_confidence, first_page_image)]
+            futures += [executor.submit(_ocr_pdf_page, file_path, page) for page in range(1, n_pages)]
+            results = [future.result() for future in futures]
+
+    pages = [(text, conf) for text, conf in results if text]
+    if not pages:
+        return "", 0.0
+    logger.info(f"[ocr] PDF scanné : {len(pages)}/{n_pages} page(s) avec du texte")
+    return "\n".join(text for text, _ in pages), sum(conf for _, conf in pages) / len(pages)
+
+
+def _ocr_pdf_pages_batched(
+    file_path: str, first_page_image: str, n_pages: int, workers: int,
+) -> list[tuple[str, float]]:
+    """
+    Rend les pages en PNG dans un dossier temporaire, puis les OCRise par lots
+    contigus (un lot par cœur), chaque lot en un seul appel tesseract.
+    Retourne (texte, confiance) pour chaque page, dans l'ordre.
+    """
+    with tempfile.TemporaryDirectory(prefix="pf_ocr_") as tmp_dir:
+        def render(page: int) -> str | None:
+            if page == 0:
+                # Déjà rendue par l'appelant : préparée et testée comme les autres
+                with Image.open(first_page_image) as first:
+                    first.load()
+                image = first
+            else:
+                image = _render_pdf_page(file_path, page)
+            if image is None:
+                return None
+            image = _prepare_for_ocr(image)
+            if image is None:
+                return None
+            path = os.path.join(tmp_dir, f"page_{page:04d}.png")
+            image.save(path, "PNG", compress_level=1)  # relu aussitôt : pas la peine de compresser
+            return path
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            paths = list(executor.map(render, range(n_pages)))
+            size = -(-n_pages // workers)
+            batches = [paths[i:i + size] for i in range(0, n_pages, size)]
+            return [
+                result
+                for batch_results in executor.map(_ocr_image_batch, batches, [tmp_dir] * len(batches))
+                for result in batch_results
+            ]
+
+
+def _ocr_image_batch(paths: list[str | None], tmp_dir: str) -> list[tuple[str, float]]:
+    """
+    OCR de plusieurs images en un seul processus tesseract (fichier liste) : le
+    modèle n'est chargé qu'une fois. Les entrées None (page non rendue ou vide)
+    donnent ("", 0.0).
+    """
+    results = [("", 0.0)] * len(paths)
+    present = [i for i, path in enumerate(paths) if path]
+    if not present:
+        return results
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", dir=tmp_dir, delete=False) as f:
+        f.write("\n".join(paths[i] for i in present) + "\n")
+        list_path = f.name
+    try:
+        with _ocr_slots:
+            tsv = pytesseract.image_to_data(list_path, lang="fra+eng")
+    except Exception as e:
+        logger.error(f"[ocr] Erreur Tesseract (lot de {len(present)} pages) : {e}")
+        return results
+
+    # Une page par image de la liste (colonne page_num, 1..n)
+    for i, (text, avg_conf, _) in zip(present, _pages_from_ocr_data(tsv, len(present))):
+        results[i] = (text, avg_conf)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Budget de tokens des textes envoyés au LLM
+# ---------------------------------------------------------------------------
+
+# En tokens : texte à corriger (correction, fusion, appel combiné) / à analyser
+_CORRECTION_MAX_TOKENS = 3000
+_ANALYSIS_MAX_TOKENS = 2000
+# Réponse d'analyse (5 champs courts) : plafond contre les réponses qui s'emballent
+_ANALYSIS_MAX_REPLY_TOKENS = 256
+# Sans tiktoken : approximation du nombre de caractères par token
+_CHARS_PER_TOKEN = 4
+_CLIP_MARKER = "\n[...]\n"
+
+
+# Vocabulaire cl100k_base tel que tiktoken le range dans son cache
+# (fichier nommé d'après le SHA-1 de son URL de téléchargement)
+_TIKTOKEN_VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+_token_encoder_lock = threading.Lock()
+
+
+def _token_encoder():
+    """Encodeur tiktoken (cl100k_base), ou None si indisponible."""
+    with _token_encoder_lock:
+        return _load_token_encoder()
+
+
+@lru_cache(maxsize=1)
+def _load_token_encoder():
+    # Jamais de téléchargement (sans délai maximal, il bloquerait le traitement
+    # des déploiements hors ligne) : seul un vocabulaire déjà présent dans
+    # TIKTOKEN_CACHE_DIR est chargé
+    cache_dir = os.getenv("TIKTOKEN_CACHE_DIR")
+    vocab = hashlib.sha1(_TIKTOKEN_VOCAB_URL.encode()).hexdigest()
+    if not cache_dir or not os.path.isfile(os.path.join(cache_dir, vocab)):
+        logger.info("[llm] Vocabulaire tiktoken absent de TIKTOKEN_CACHE_DIR, budget estimé en caractères")
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # non installé, ou vocabulaire illisible
+        logger.info(f"[llm] tiktoken indisponible, budget estimé en caractères : {e}")
+        return None
+
+
+def _clip_tokens(text: str, max_tokens: int) -> str:
+    """
+    Limite text à environ max_tokens tokens en gardant le début et la fin
+    (en-tête et pied des documents administratifs : émetteur, dates, totaux),
+    le milieu étant remplacé par « [...] ». Retourne text tel quel s'il tient.
+    """
+    head = max_tokens * 2 // 3
+    tail = max_tokens - head
+    enc = _token_encoder()
+    if enc is None:
+        if len(text) <= max_tokens * _CHARS_PER_TOKEN:
+            return text
+        return text[:head * _CHARS_PER_TOKEN] + _CLIP_MARKER + text[-tail * _CHARS_PER_TOKEN:]
+    ids = enc.encode(text, disallowed_special=())
+    if len(ids) <= max_tokens:
+        return text
+    return enc.decode(ids[:head]) + _CLIP_MARKER + enc.decode(ids[-tail:])
+
+
 # ---------------------------------------------------------------------------
 # Correction OCR — indépendante (texte seul)
 # ---------------------------------------------------------------------------
@@ -246,18 +700,18 @@ def correct_ocr_with_llm(text: str, confidence: float, config: dict) -> str:
         return text
 
     logger.info(f"[ocr-correction] Confiance {confidence:.0f}% < seuil {threshold}% → correction LLM")
-    prompt = OCR_CORRECTION_PROMPT.format(confidence=f"{confidence:.0f}")
     try:
-        client = OpenAI(base_url=config["base_url"], api_key=config["api_key"])
-        response = client.chat.completions.create(
+        client = openai_client(config["base_url"], config["api_key"])
+        corrected = _chat_completion(
+            client, str.strip,
             model=config["model"],
             messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user",   "content": text[:4000]},
+                # Prompt système constant → préfixe identique d'un document à l'autre
+                {"role": "system", "content": OCR_CORRECTION_PROMPT},
+                {"role": "user",   "content": f"Score de confiance OCR : {confidence:.0f}%\n---\n{_clip_tokens(text, _CORRECTION_MAX_TOKENS)}"},
             ],
             temperature=0.1,
         )
-        corrected = response.choices[0].message.content.strip()
         logger.info(f"[ocr-correction] Texte corrigé ({len(corrected)} chars)")
         return corrected
     except Exception as e:
@@ -265,6 +719,46 @@ def correct_ocr_with_llm(text: str, confidence: float, config: dict) -> str:
         return text
 
 
+# ---------------------------------------------------------------------------
+# Correction OCR + analyse — un seul appel LLM (vision désactivée)
+# ---------------------------------------------------------------------------
+
+def correct_and_analyze_with_llm(text: str, confidence: float, config: dict) -> tuple[str, dict]:
+    """
+    Correction OCR puis analyse, retourne (texte_corrigé, analyse_dict).
+    Quand une correction est nécessaire, les deux sont demandées en un seul
+    appel (un aller-retour et un envoi du texte au lieu de deux).
+    Repli sur correct_ocr_with_llm + analyze_with_llm si le texte est vide ou
+    trop long, si aucune correction n'est nécessaire ou si l'appel combiné échoue.
+    """
+    threshold = config.get("ocr_correction_threshold", 80)
+    # Texte dépassant le budget : deux appels (chacun le tronque à son budget)
+    if (text.strip() and config.get("ocr_llm_correction", True)
+            and confidence < threshold and _clip_tokens(text, _CORRECTION_MAX_TOKENS) == text):
+        logger.info(f"[ocr-correction] Confiance {confidence:.0f}% < seuil {threshold}% → correction + analyse LLM")
+        try:
+            client = openai_client(config["base_url"], config["api_key"])
+            analysis = _json_completion(
+                client,
+                model=config["model"],
+                messages=[
+                    {"role": "system", "content": OCR_CORRECT_AND_ANALYZE_PROMPT},
+                    {"role": "user",   "content": f"Score de confiance OCR : {confidence:.0f}%\n---\n{text}"},
+                ],
+                temperature=0.1,
+            )
+            corrected = analysis.pop("corrected_text", None)
+            if isinstance(corrected, str) and corrected.strip():
+                logger.info(f"[ocr-correction] Texte corrigé ({len(corrected.strip())} chars)")
+                return corrected.strip(), analysis
+            logger.warning("[ocr-correction] Réponse combinée sans texte corrigé → deux appels")
+        except Exception as e:
+            logger.warning(f"[ocr-correction] Appel combiné en échec → deux appels : {e}")
+
+    corrected = correct_ocr_with_llm(text, confidence, config) if text.strip() else text
+    return corrected, analyze_with_llm(corrected, config)
+
+
 # ---------------------------------------------------------------------------
 # Correction OCR avec fusion vision — utilisée dans la voie b) vision activée
 # ---------------------------------------------------------------------------
@@ -290,32 +784,33 @@ def correct_ocr_with_vision_fusion(
 
     logger.info(f"[ocr-fusion] Correction avec fusion vision (confiance={confidence:.0f}%)")
     try:
-        mime, b64 = _image_to_base64(file_path)
+        data_url = _image_data_url(file_path)
         client, model = _get_vision_client(config)
         ctx_printed = vision_context.get("extracted_text_printed", "Non disponible")[:500] if vision_context else "Non disponible"
         ctx_handwritten = vision_context.get("extracted_text_handwritten") or "Aucun élément manuscrit détecté"
         if len(ctx_handwritten) > 500:
             ctx_handwritten = ctx_handwritten[:500]
-        prompt = OCR_VISION_FUSION_PROMPT.format(
+        sources = OCR_VISION_FUSION_INPUT.format(
             confidence=f"{confidence:.0f}",
             vision_context_printed=ctx_printed,
             vision_context_handwritten=ctx_handwritten,
-            ocr_text=ocr_text[:3000],
+            ocr_text=_clip_tokens(ocr_text, _CORRECTION_MAX_TOKENS),
         )
-        response = client.chat.completions.create(
+        corrected = _chat_completion(
+            client, str.strip,
             model=model,
-            messages=[{
-                "role": "user",
-                "content": [
+            messages=[
+                # Consignes constantes en tête (cache de préfixe), données variables ensuite
+                {"role": "system", "content": OCR_VISION_FUSION_PROMPT},
+                {"role": "user", "content": [
                     {"type": "image_url",
-                     "image_url": {"url": f"data:{mime};base64,{b64}", "detail": "high"}},
-                    {"type": "text", "text": prompt},
-                ],
-            }],
+                     "image_url": {"url": data_url, "detail": "high"}},
+                    {"type": "text", "text": sources},
+                ]},
+            ],
             temperature=0.1,
             max_tokens=2000,
         )
-        corrected = response.choices[0].message.content.strip()
         logger.info(f"[ocr-fusion] Texte corrigé ({len(corrected)} chars)")
         return corrected
     except Exception as e:
@@ -327,6 +822,148 @@ def correct_ocr_with_vision_fusion(
 # Vision — client et utilitaires
 # ---------------------------------------------------------------------------
 
+# Connexions gardées ouvertes entre deux documents : le délai par défaut (5 s) est
+# plus court que l'OCR d'une page, la connexion serait rouverte à chaque appel
+_LLM_KEEPALIVE_EXPIRY = 60.0
+
+
+@lru_cache(maxsize=1)
+def llm_http_client():
+    """Pool HTTP keep-alive commun à tous les clients LLM (traitement et recherche)."""
+    from openai import DefaultHttpxClient, DEFAULT_CONNECTION_LIMITS
+    # Même classe Limits que le client HTTP d'openai, sans en dépendre directement
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+        max_keepalive_connections=32,
+        keepalive_expiry=_LLM_KEEPALIVE_EXPIRY,
+    )
+    # HTTP/2 (si h2 est installé) : requêtes multiplexées sur une seule connexion
+    # TLS vers les fournisseurs distants ; les serveurs locaux en http:// restent en HTTP/1.1
+    http2 = importlib.util.find_spec("h2") is not None
+    return DefaultHttpxClient(limits=limits, http2=http2)
+
+
+def openai_client(base_url: str | None, api_key: str) -> OpenAI:
+    """Client OpenAI partagé pour (base_url, api_key) : traitement et recherche LLM."""
+    # Normalisé : un espace saisi dans les réglages ne crée pas un second client
+    return _openai_client_for(base_url.strip() if base_url else base_url, api_key.strip())
+
+
+@lru_cache(maxsize=4)
+def _openai_client_for(base_url: str | None, api_key: str) -> OpenAI:
+    """Client OpenAI partagé par (base_url, api_key) : pool de connexions réutilisé entre documents."""
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=llm_http_client())
+
+
+# Réponses LLM mémorisées par empreinte de la requête (serveur, modèle, messages) :
+# retraiter un même document (réimport, relance) ne rappelle pas le LLM.
+# Deux niveaux : mémoire (LRU) puis table llm_cache (survit aux redémarrages).
+# Chaque réponse est rattachée au document traité et effacée avec lui (forget_llm_cache).
+_LLM_CACHE_SIZE = 256
+_llm_cache: "OrderedDict[str, tuple[int | None, str]]" = OrderedDict()
+_llm_cache_lock = threading.Lock()
+_LLM_DB_CACHE_SIZE = 10_000
+_LLM_DB_CACHE_TTL = datetime.timedelta(days=30)
+
+# Document en cours de traitement (posé par process_document) ; sans document,
+# les réponses ne sont gardées qu'en mémoire
+_llm_cache_doc: "contextvars.ContextVar[int | None]" = contextvars.ContextVar("llm_cache_doc", default=None)
+
+
+def _submit(executor, fn, *args, **kwargs):
+    """executor.submit dans le contexte courant : le document de _llm_cache_doc suit l'appel."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _llm_cache_load(key: str) -> tuple[int, str] | None:
+    """(doc_id, réponse) mémorisés en base pour key (None si absente ou expirée)."""
+    try:
+        from database import SessionLocal, LLMCacheEntry, utcnow
+        now = utcnow()
+        with SessionLocal.begin() as db:
+            entry = db.get(LLMCacheEntry, key)
+            if entry is None:
+                return None
+            if entry.used_at < now - _LLM_DB_CACHE_TTL:
+                db.delete(entry)
+                return None
+            entry.used_at = now
+            return entry.doc_id, entry.content
+    except Exception as e:
+        logger.warning(f"[llm] Cache en base illisible : {e}")
+        return None
+
+
+def _llm_cache_store(key: str, doc_id: int, content: str):
+    """Enregistre une réponse en base ; purge les entrées expirées et les plus anciennes au-delà de la taille max."""
+    try:
+        from sqlalchemy import delete, select
+        from database import SessionLocal, LLMCacheEntry, utcnow
+        now = utcnow()
+        with SessionLocal.begin() as db:
+            db.merge(LLMCacheEntry(key=key, content=content, doc_id=doc_id, used_at=now))
+            db.flush()
+            db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.used_at < now - _LLM_DB_CACHE_TTL))
+            overflow = (select(LLMCacheEntry.key)
+                        .order_by(LLMCacheEntry.used_at.desc())
+                        .offset(_LLM_DB_CACHE_SIZE))
+            db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key.in_(overflow)))
+    except Exception as e:
+        logger.warning(f"[llm] Cache en base non enregistré : {e}")
+
+
+def forget_llm_cache(db, doc_id: int):
+    """
+    Efface les réponses LLM rattachées à doc_id (texte corrigé, résumé, montant…) :
+    en mémoire tout de suite, en base dans la session db (validée par l'appelant).
+    """
+    from sqlalchemy import delete
+    from database import LLMCacheEntry
+    with _llm_cache_lock:
+        for key in [k for k, (d, _) in _llm_cache.items() if d == doc_id]:
+            del _llm_cache[key]
+    db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.doc_id == doc_id))
+
+
+def _chat_completion(client: OpenAI, parse, **request):
+    """
+    Appelle chat.completions et retourne parse(contenu de la réponse).
+    Le contenu n'est mis en cache que si parse réussit : une réponse
+    inexploitable sera redemandée au prochain traitement.
+    """
+    key = hashlib.sha256(_json_dumps_sorted([str(client.base_url), request])).hexdigest()
+    with _llm_cache_lock:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            _llm_cache.move_to_end(key)
+    if cached is None:
+        cached = _llm_cache_load(key)
+        if cached is not None:
+            _llm_cache_remember(key, *cached)
+    if cached is not None:
+        logger.info("[llm] Réponse servie depuis le cache")
+        return parse(cached[1])
+
+    response = client.chat.completions.create(**request)
+    if request.get("stream"):
+        content = _read_json_stream(response)
+    else:
+        content = response.choices[0].message.content or ""
+    result = parse(content)
+    doc_id = _llm_cache_doc.get()
+    _llm_cache_remember(key, doc_id, content)
+    if doc_id is not None:
+        _llm_cache_store(key, doc_id, content)
+    return result
+
+
+def _llm_cache_remember(key: str, doc_id: int | None, content: str):
+    with _llm_cache_lock:
+        _llm_cache[key] = (doc_id, content)
+        if len(_llm_cache) > _LLM_CACHE_SIZE:
+            _llm_cache.popitem(last=False)
+
+
 def _get_vision_client(config: dict) -> tuple:
     provider = config.get("vision_provider", "local")
     v_model  = config.get("vision_model") or config.get("model", "")
@@ -334,56 +971,95 @@ def _get_vision_client(config: dict) -> tuple:
     v_url    = config.get("vision_base_url") or config.get("base_url", "")
 
     if provider == "openai":
-        return OpenAI(api_key=v_key or os.getenv("OPENAI_API_KEY", "")), v_model or "gpt-4o"
+        return openai_client(None, v_key or os.getenv("OPENAI_API_KEY", "")), v_model or "gpt-4o"
     elif provider == "anthropic":
-        return OpenAI(
-            base_url="https://api.anthropic.com/v1",
-            api_key=v_key or os.getenv("ANTHROPIC_API_KEY", ""),
+        return openai_client(
+            "https://api.anthropic.com/v1",
+            v_key or os.getenv("ANTHROPIC_API_KEY", ""),
         ), v_model or "claude-3-5-sonnet-20241022"
     elif provider == "gemini":
-        return OpenAI(
-            base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-            api_key=v_key or os.getenv("GEMINI_API_KEY", ""),
+        return openai_client(
+            "https://generativelanguage.googleapis.com/v1beta/openai/",
+            v_key or os.getenv("GEMINI_API_KEY", ""),
         ), v_model or "gemini-2.5-flash-preview-05-20"
     else:
-        return OpenAI(base_url=v_url, api_key=v_key), v_model or config.get("model", "local-model")
+        return openai_client(v_url, v_key), v_model or config.get("model", "local-model")
+
+def _image_data_url(file_path: str) -> str:
+    st = os.stat(file_path)
+    return _encode_data_url(file_path, st.st_mtime_ns, st.st_size)
 
-def _image_to_base64(file_path: str) -> tuple[str, str]:
-    ext = os.path.splitext(file_path)[1].lower()
-    mime_map = {".jpg": "image/jpeg", ".jpeg": "image/jpeg",
-                ".png": "image/png", ".bmp": "image/bmp",
-                ".tiff": "image/tiff", ".webp": "image/webp"}
-    mime = mime_map.get(ext, "image/jpeg")
-    with open(file_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    return mime, b64
+
+# Les modèles vision réduisent l'image de toute façon : au-delà de ce côté, on
+# redimensionne et recompresse en JPEG avant l'envoi (requête 5 à 20x plus légère)
+_VISION_MAX_SIDE = 1568
+_VISION_JPEG_QUALITY = 85
+# Formats acceptés tels quels par les API vision quand l'image est déjà petite
+_VISION_PASSTHROUGH = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Taille des blocs lus pour l'encodage base64 (multiple de 3 : pas de padding intermédiaire)
+_B64_CHUNK = 3 * 64 * 1024
+
+
+@lru_cache(maxsize=2)
+def _encode_data_url(file_path: str, mtime_ns: int, size: int) -> str:
+    """
+    URL data: de l'image, construite une seule fois par version du fichier (vision
+    puis fusion OCR l'envoient deux fois). Une petite image JPEG/PNG/WebP est
+    encodée par blocs depuis le fichier ; sinon elle est réduite à
+    _VISION_MAX_SIDE et recompressée en JPEG en mémoire.
+    """
+    encode = _b64encoder()
+    with Image.open(file_path) as img:
+        mime = _VISION_PASSTHROUGH.get(img.format)
+        if mime and max(img.size) <= _VISION_MAX_SIDE:
+            out = bytearray(f"data:{mime};base64,".encode("ascii"))
+            with open(file_path, "rb") as f:
+                while chunk := f.read(_B64_CHUNK):
+                    out += encode(chunk)
+            return out.decode("ascii")
+
+        img.draft("RGB", (_VISION_MAX_SIDE, _VISION_MAX_SIDE))  # JPEG : décodage déjà réduit
+        img.thumbnail((_VISION_MAX_SIDE, _VISION_MAX_SIDE))
+        # L'orientation EXIF serait perdue au réencodage : on l'applique aux pixels
+        img = ImageOps.exif_transpose(img)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=_VISION_JPEG_QUALITY, optimize=True)
+    out = bytearray(b"data:image/jpeg;base64,")
+    out += encode(buf.getbuffer())
+    return out.decode("ascii")
+
+
+@lru_cache(maxsize=1)
+def _b64encoder():
+    """b64encode de pybase64 (SIMD, plusieurs fois plus rapide) s'il est installé, sinon la stdlib."""
+    try:
+        import pybase64
+        return pybase64.b64encode
+    except ImportError:
+        return base64.b64encode
 
 
 def analyze_with_vision(file_path: str, config: dict) -> dict:
     """Voie a) : Image base64 → LLM multimodal → JSON structuré."""
     logger.info(f"[vision-a] Analyse vision directe : {file_path}")
     try:
-        mime, b64 = _image_to_base64(file_path)
+        data_url = _image_data_url(file_path)
         client, model = _get_vision_client(config)
-        response = client.chat.completions.create(
+        result = _json_completion(
+            client,
             model=model,
-            messages=[{
-                "role": "user",
-                "content": [
+            messages=[
+                # Consignes constantes en tête (cache de préfixe), image ensuite
+                {"role": "system", "content": VISION_SYSTEM_PROMPT},
+                {"role": "user", "content": [
                     {"type": "image_url",
-                     "image_url": {"url": f"data:{mime};base64,{b64}", "detail": "high"}},
-                    {"type": "text", "text": VISION_SYSTEM_PROMPT},
-                ],
-            }],
+                     "image_url": {"url": data_url, "detail": "high"}},
+                ]},
+            ],
             temperature=0.1,
             max_tokens=1500,
         )
-        raw = response.choices[0].message.content.strip()
-        if raw.startswith("```"):
-            raw = raw.split("```")[1]
-            if raw.startswith("json"):
-                raw = raw[4:]
-        result = json.loads(raw)
         logger.info(f"[vision-a] {result.get('category')} — {result.get('summary')}")
         return result
     except json.JSONDecodeError:
@@ -406,21 +1082,17 @@ def analyze_with_llm(text: str, config: dict | None = None) -> dict:
     if config is None:
         config = get_llm_config()
     try:
-        client = OpenAI(base_url=config["base_url"], api_key=config["api_key"])
-        response = client.chat.completions.create(
+        client = openai_client(config["base_url"], config["api_key"])
+        return _json_completion(
+            client,
             model=config["model"],
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user",   "content": text[:3000]},
+                {"role": "user",   "content": _clip_tokens(text, _ANALYSIS_MAX_TOKENS)},
             ],
             temperature=0.1,
+            max_tokens=_ANALYSIS_MAX_REPLY_TOKENS,
         )
-        raw = response.choices[0].message.content.strip()
-        if raw.startswith("```"):
-            raw = raw.split("```")[1]
-            if raw.startswith("json"):
-                raw = raw[4:]
-        return json.loads(raw)
     except json.JSONDecodeError:
         return {"category": "Autre", "summary": "Analyse impossible (JSON invalide)",
                 "date": None, "amount": None, "issuer": None}
@@ -429,6 +1101,121 @@ def analyze_with_llm(text: str, config: dict | None = None) -> dict:
                 "date": None, "amount": None, "issuer": None}
 
 
+# Mode JSON (OpenAI, Ollama, LM Studio, vLLM…) : la réponse est un objet JSON
+# sans bloc ``` ni texte autour. Les serveurs qui refusent le paramètre sont
+# mémorisés et interrogés sans, _parse_llm_json restant tolérant.
+_JSON_MODE = {"type": "json_object"}
+_json_mode_unsupported: set[str] = set()
+
+
+def _json_completion(client: OpenAI, **request) -> dict:
+    """Appel LLM attendant un objet JSON, en mode JSON si le serveur l'accepte."""
+    server = str(client.base_url)
+    if server not in _json_mode_unsupported:
+        try:
+            return _chat_completion(client, _parse_llm_json, stream=True,
+                                    response_format=_JSON_MODE, **request)
+        except BadRequestError as e:
+            logger.info(f"[llm] Mode JSON refusé par {server}, nouvel essai sans : {e}")
+            _json_mode_unsupported.add(server)
+    return _chat_completion(client, _parse_llm_json, stream=True, **request)
+
+
+def _read_json_stream(stream) -> str:
+    """
+    Concatène une réponse en flux et l'arrête dès que le premier objet JSON est
+    complet : fermer le flux fait cesser la génération côté serveur (texte ou
+    bavardage après l'objet, fréquents avec les modèles locaux).
+    """
+    parts: list[str] = []
+    depth = 0
+    in_string = escaped = False
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            for i, ch in enumerate(delta):
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif ch == "\\":
+                        escaped = True
+                    elif ch == '"':
+                        in_string = False
+                elif ch == '"' and depth:
+                    in_string = True
+                elif ch == "{":
+                    depth += 1
+                elif ch == "}" and depth:
+                    depth -= 1
+                    if not depth:
+                        parts.append(delta[:i + 1])
+                        return "".join(parts)
+            parts.append(delta)
+    finally:
+        stream.close()
+    return "".join(parts)
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_llm_json(raw: str):
+    """
+    Décode le premier objet JSON d'une réponse LLM, qu'il soit entouré d'un bloc
+    ```json … ``` ou de texte. Lève json.JSONDecodeError s'il n'y en a pas.
+    """
+    start = raw.find("{")
+    if start < 0:
+        return json.loads(raw)
+    try:
+        # Cas courant (mode JSON) : un objet seul, décodé d'un bloc
+        return _json_loads()(raw[start:raw.rfind("}") + 1])
+    except ValueError:
+        return _JSON_DECODER.raw_decode(raw, start)[0]
+
+
+def _json_dumps_sorted(obj) -> bytes:
+    """
+    JSON compact, clés triées, en UTF-8 : orjson s'il est installé (la requête
+    vision contient l'image en base64, souvent plusieurs centaines de Ko),
+    sinon la stdlib avec une sortie identique.
+    """
+    try:
+        import orjson
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    except ImportError:
+        return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _json_loads():
+    """loads d'orjson (Rust, plus rapide sur les longues réponses) s'il est installé, sinon la stdlib."""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+
+# Similarité (mots en commun) au-delà de laquelle l'analyse du texte brut reste valable
+_SPECULATIVE_MIN_SIMILARITY = 0.95
+
+
+def _texts_similar(a: str, b: str) -> bool:
+    """
+    True si b ne diffère de a que marginalement : coefficient de Dice sur les
+    multi-ensembles de mots (linéaire, contrairement à difflib sur de longs textes).
+    """
+    if a == b:
+        return True
+    words_a, words_b = Counter(a.split()), Counter(b.split())
+    total = sum(words_a.values()) + sum(words_b.values())
+    if not total:
+        return True
+    return 2 * sum((words_a & words_b).values()) / total >= _SPECULATIVE_MIN_SIMILARITY
+
+
 def _merge_analyses(vision_json: dict, ocr_json: dict) -> dict:
     """
     Fusionne les deux JSON (voie a et voie b).
@@ -454,51 +1241,50 @@ def apply_classification_rules(analysis: dict, text: str = "") -> dict:
     """Applique les règles de reclassification personnalisées (conditions AND) après l'analyse LLM."""
     try:
         from database import SessionLocal, ClassificationRule, RuleCondition
-        db = SessionLocal()
-        rules = (
-            db.query(ClassificationRule)
-            .filter(ClassificationRule.enabled == "true")
-            .order_by(ClassificationRule.priority.desc())
-            .all()
-        )
-
-        for rule in rules:
-            conditions = db.query(RuleCondition).filter(RuleCondition.rule_id == rule.id).all()
-            if not conditions:
-                continue
+        with SessionLocal() as db:
+            rules = (
+                db.query(ClassificationRule)
+                .filter(ClassificationRule.enabled == "true")
+                .order_by(ClassificationRule.priority.desc())
+                .all()
+            )
 
-            all_match = True
-            for cond in conditions:
-                field = cond.match_field
-                value = (cond.match_value or "").lower().strip()
-
-                if field == "issuer":
-                    haystack = (analysis.get("issuer") or "").lower()
-                    if value not in haystack:
-                        all_match = False; break
-                elif field == "category":
-                    haystack = (analysis.get("category") or "").lower()
-                    if value not in haystack:
-                        all_match = False; break
-                elif field == "content":
-                    if value not in text.lower():
-                        all_match = False; break
-                elif field == "amount_not_null":
-                    if not analysis.get("amount"):
-                        all_match = False; break
-                elif field == "amount_null":
-                    if analysis.get("amount"):
-                        all_match = False; break
-                else:
+            for rule in rules:
+                conditions = db.query(RuleCondition).filter(RuleCondition.rule_id == rule.id).all()
+                if not conditions:
                     continue
 
-            if all_match:
-                original = analysis.get("category")
-                analysis["category"] = rule.target_category
-                logger.info(f"[rules] Règle '{rule.name}' appliquée : {original} → {rule.target_category}")
-                break  # La règle prioritaire gagne
+                all_match = True
+                for cond in conditions:
+                    field = cond.match_field
+                    value = (cond.match_value or "").lower().strip()
+
+                    if field == "issuer":
+                        haystack = (analysis.get("issuer") or "").lower()
+                        if value not in haystack:
+                            all_match = False; break
+                    elif field == "category":
+                        haystack = (analysis.get("category") or "").lower()
+                        if value not in haystack:
+                            all_match = False; break
+                    elif field == "content":
+                        if value not in text.lower():
+                            all_match = False; break
+                    elif field == "amount_not_null":
+                        if not analysis.get("amount"):
+                            all_match = False; break
+                    elif field == "amount_null":
+                        if analysis.get("amount"):
+                            all_match = False; break
+                    else:
+                        continue
+
+                if all_match:
+                    original = analysis.get("category")
+                    analysis["category"] = rule.target_category
+                    logger.info(f"[rules] Règle '{rule.name}' appliquée : {original} → {rule.target_category}")
+                    break  # La règle prioritaire gagne
 
-        db.close()
     except Exception as e:
         logger.warning(f"[rules] Erreur lors de l'application des règles : {e}")
 
@@ -509,7 +1295,9 @@ def apply_classification_rules(analysis: dict, text: str = "") -> dict:
 # Point d'entrée principal — nouveau pipeline
 # ---------------------------------------------------------------------------
 
-def process_document(file_path: str) -> tuple[str, dict]:
+def process_document(
+    file_path: str, doc_id: int | None = None, enhanced_path: str | None = None,
+) -> tuple[str, dict]:
     """
     Pipeline complet selon le type de fichier et la configuration.
 
@@ -521,28 +1309,35 @@ def process_document(file_path: str) -> tuple[str, dict]:
       Conversion pages → images → OCR/Vision selon config → LLM → JSON
 
     Image — Vision DÉSACTIVÉE :
-      Enhance → Tesseract OCR → Score confiance → Correction LLM si < seuil → LLM → JSON
+      Enhance → Tesseract OCR → Score confiance → LLM → JSON
+      (si confiance < seuil : correction + analyse en un seul appel LLM)
 
     Image — Vision ACTIVÉE (double voie parallèle) :
       Voie a) Image base64 → LLM multimodal → JSON structuré
       Voie b) Tesseract OCR → Score confiance → Fusion/correction avec JSON vision → LLM → JSON
       → Merge des deux JSON (voie b prioritaire sur les champs structurés)
 
+    Les réponses LLM mises en cache sont rattachées à doc_id (voir forget_llm_cache).
+    enhanced_path : image déjà améliorée par l'appelant (qui la réutilise pour
+    le PDF searchable et la supprime ensuite) ; sinon elle est produite ici.
+
     Retourne (texte_extrait_ou_corrigé, analyse_dict).
     """
     config = get_llm_config()
     ext = os.path.splitext(file_path)[1].lower()
-    is_image = ext in (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".webp")
+    is_image = ext in IMAGE_EXTS
 
     # ── Prétraitement image ─────────────────────────────────────────────────
-    enhanced_path = file_path
     cleanup_enhanced = False
-    if is_image:
-        enhanced_path = enhance_image(file_path, output_dir=None)
-        cleanup_enhanced = (enhanced_path != file_path)
-        if cleanup_enhanced:
-            logger.info(f"[processor] Image améliorée : {os.path.basename(enhanced_path)}")
+    if enhanced_path is None:
+        enhanced_path = file_path
+        if is_image:
+            enhanced_path = enhance_image(file_path, output_dir=None)
+            cleanup_enhanced = (enhanced_path != file_path)
+            if cleanup_enhanced:
+                logger.info(f"[processor] Image améliorée : {os.path.basename(enhanced_path)}")
 
+    cache_doc = _llm_cache_doc.set(doc_id)
     try:
         # ── Vision ACTIVÉE — double voie parallèle ──────────────────────────
         if is_image and config.get("vision_enabled"):
@@ -551,9 +1346,9 @@ def process_document(file_path: str) -> tuple[str, dict]:
             # Lancer les deux voies en parallèle
             with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
                 # Voie a) : vision directe
-                future_a = executor.submit(analyze_with_vision, enhanced_path, config)
+                future_a = _submit(executor, analyze_with_vision, enhanced_path, config)
                 # Voie b) commence par l'OCR (indépendant)
-                future_ocr = executor.submit(extract_text_with_confidence, enhanced_path)
+                future_ocr = executor.submit(extract_text_with_confidence, enhanced_path, ext)
 
                 vision_result = future_a.result()
                 ocr_text, confidence = future_ocr.result()
@@ -562,17 +1357,27 @@ def process_document(file_path: str) -> tuple[str, dict]:
 
             # Voie b) : correction/fusion OCR avec contexte vision, puis analyse LLM
             extracted_text = vision_result.get("extracted_text_printed", "") or ocr_text
-            if ocr_text.strip() and config.get("ocr_vision_fusion", True):
-                corrected_text = correct_ocr_with_vision_fusion(
-                    enhanced_path, ocr_text, confidence, config,
-                    vision_context={k: v for k, v in vision_result.items() if k not in ("extracted_text_printed", "extracted_text_handwritten")}
-                )
-            elif ocr_text.strip():
-                corrected_text = correct_ocr_with_llm(ocr_text, confidence, config)
+            if ocr_text.strip():
+                # Analyse spéculative du texte OCR brut pendant la correction : si la
+                # correction change peu le texte, son résultat évite un aller-retour LLM
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    if config.get("ocr_vision_fusion", True):
+                        vision_context = {k: v for k, v in vision_result.items()
+                                          if k not in ("extracted_text_printed", "extracted_text_handwritten")}
+                        future_fix = _submit(executor, correct_ocr_with_vision_fusion,
+                                             enhanced_path, ocr_text, confidence, config,
+                                             vision_context=vision_context)
+                    else:
+                        future_fix = _submit(executor, correct_ocr_with_llm, ocr_text, confidence, config)
+                    future_spec = _submit(executor, analyze_with_llm, ocr_text, config)
+                    corrected_text = future_fix.result()
+                    ocr_json = future_spec.result()
+                if not _texts_similar(ocr_text, corrected_text):
+                    logger.info("[processor] Correction significative — nouvelle analyse du texte corrigé")
+                    ocr_json = analyze_with_llm(corrected_text, config)
             else:
                 corrected_text = extracted_text
-
-            ocr_json = analyze_with_llm(corrected_text, config)
+                ocr_json = analyze_with_llm(corrected_text, config)
             logger.info(f"[processor] Voie b) JSON OCR+LLM : {ocr_json.get('category')}")
 
             # Fusion des deux JSON
@@ -587,31 +1392,34 @@ def process_document(file_path: str) -> tuple[str, dict]:
 
         # ── Vision DÉSACTIVÉE — pipeline OCR classique ──────────────────────
         if is_image:
-            ocr_text, confidence = extract_text_with_confidence(enhanced_path)
+            ocr_text, confidence = extract_text_with_confidence(enhanced_path, ext)
             logger.info(f"[processor] OCR confiance={confidence:.1f}%")
-            corrected_text = correct_ocr_with_llm(ocr_text, confidence, config) if ocr_text.strip() else ocr_text
+            corrected_text, analysis = correct_and_analyze_with_llm(ocr_text, confidence, config)
         else:
             corrected_text = _extract_pdf_text(file_path)
             confidence = 100.0
 
-            # ── Fallback PDF scanné : texte trop court → OCR sur la 1ère page ──
+            # ── Fallback PDF scanné : texte trop court → OCR des pages ──────────
             if len(corrected_text.strip()) < 50:
-                logger.info("[processor] PDF scanné détecté (texte insuffisant) — fallback OCR sur page 1")
+                logger.info("[processor] PDF scanné détecté (texte insuffisant) — fallback OCR")
                 page_image_path = _pdf_page_to_image(file_path, page=0)
                 if page_image_path:
                     try:
                         if config.get("vision_enabled"):
-                            # Réutiliser la voie vision sur l'image extraite
-                            vision_result = analyze_with_vision(page_image_path, config)
-                            ocr_text, ocr_conf = extract_text_with_confidence(page_image_path)
+                            # Réutiliser la voie vision sur l'image extraite, en
+                            # parallèle de l'OCR des pages (indépendants)
+                            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                                future_vision = _submit(executor, analyze_with_vision, page_image_path, config)
+                                future_ocr = executor.submit(_ocr_pdf_pages, file_path, page_image_path)
+                                vision_result = future_vision.result()
+                                ocr_text, ocr_conf = future_ocr.result()
                             corrected_text = ocr_text or vision_result.get("extracted_text", "")
                             analysis = analyze_with_llm(corrected_text, config)
                             analysis = _merge_analyses(vision_result, analysis)
                             analysis["pipeline_sources"] = ["vision", "ocr+llm"]
                         else:
-                            ocr_text, confidence = extract_text_with_confidence(page_image_path)
-                            corrected_text = correct_ocr_with_llm(ocr_text, confidence, config) if ocr_text.strip() else ocr_text
-                            analysis = analyze_with_llm(corrected_text, config)
+                            ocr_text, confidence = _ocr_pdf_pages(file_path, page_image_path)
+                            corrected_text, analysis = correct_and_analyze_with_llm(ocr_text, confidence, config)
                             analysis["pipeline_sources"] = ["ocr+llm"]
                         analysis = apply_classification_rules(analysis, corrected_text)
                         return corrected_text, analysis
@@ -621,13 +1429,15 @@ def process_document(file_path: str) -> tuple[str, dict]:
                         except OSError:
                             pass
 
-        analysis = analyze_with_llm(corrected_text, config)
+            analysis = analyze_with_llm(corrected_text, config)
+
         if confidence < 60 and is_image:
             analysis["ocr_confidence"] = round(confidence, 1)
         analysis = apply_classification_rules(analysis, corrected_text)
         return corrected_text, analysis
 
     finally:
+        _llm_cache_doc.reset(cache_doc)
         if cleanup_enhanced and os.path.exists(enhanced_path):
             try:
                 os.remove(enhanced_path)
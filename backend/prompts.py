@@ -2,7 +2,9 @@
 prompts.py — Centralisation de tous les prompts système envoyés au LLM.
 
 Les prompts avec variables utilisent la syntaxe .format() standard :
-    prompt = OCR_CORRECTION_PROMPT.format(confidence=85)
+    prompt = OCR_VISION_FUSION_PROMPT.format(confidence=85, ...)
+Les prompts système restent constants (aucune variable) : identiques d'un
+document à l'autre, ils profitent du cache de préfixe des fournisseurs LLM.
 """
 
 # ---------------------------------------------------------------------------
@@ -23,7 +25,7 @@ Ne réponds rien d'autre que le JSON."""
 
 # ---------------------------------------------------------------------------
 # Correction OCR — texte seul (sans image)
-# Variables : {confidence}
+# Prompt système constant : le score de confiance est dans le message utilisateur
 # ---------------------------------------------------------------------------
 
 OCR_CORRECTION_PROMPT = """Tu es un expert en correction de texte OCR pour des documents administratifs français.
@@ -36,12 +38,41 @@ Le texte suivant a été extrait par OCR (reconnaissance optique de caractères)
 Corrige ces erreurs en te basant sur le contexte (document administratif français).
 Retourne UNIQUEMENT le texte corrigé, sans commentaires ni explications.
 Conserve la structure et la mise en page originale autant que possible.
-Score de confiance OCR fourni : {confidence}% — plus il est bas, plus la correction est importante."""
+Le message commence par le score de confiance OCR (plus il est bas, plus la correction est importante),
+suivi du texte à corriger après la ligne « --- ». Ne recopie pas le score."""
+
+
+# ---------------------------------------------------------------------------
+# Correction OCR + analyse en un seul appel (texte seul)
+# Prompt système constant : même message utilisateur que OCR_CORRECTION_PROMPT
+# ---------------------------------------------------------------------------
+
+OCR_CORRECT_AND_ANALYZE_PROMPT = """Tu es un expert en correction de texte OCR et en analyse de documents administratifs français.
+Le message commence par le score de confiance OCR (plus il est bas, plus la correction est importante),
+suivi, après la ligne « --- », d'un texte extrait par OCR pouvant contenir des erreurs typiques
+(lettres confondues l/1/I, 0/O, rn/m, espaces manquants ou en trop, ponctuation incorrecte, mots coupés).
+
+1. Corrige ces erreurs en te basant sur le contexte, en conservant la structure et la mise en page.
+2. Analyse le document corrigé.
+
+Réponds UNIQUEMENT avec un objet JSON valide contenant :
+{
+  "corrected_text": "le texte corrigé complet, sans commentaires",
+  "category": "une catégorie parmi : Facture, Impôts, Santé, Banque, Contrat, Assurance, Travail, Courrier, Autre",
+  "summary": "résumé en 15 mots maximum",
+  "date": "date principale du document au format YYYY-MM-DD ou null",
+  "amount": "montant principal en chiffres avec devise ou null",
+  "issuer": "organisme ou entreprise émettrice ou null"
+}
+Ne réponds rien d'autre que le JSON."""
 
 
 # ---------------------------------------------------------------------------
 # Correction OCR avec fusion vision — image + vision manuscrit + vision imprimé + texte OCR
-# Variables : {confidence}, {vision_context}, {ocr_text}
+# Prompt système constant ; les sources variables sont dans le message utilisateur
+# (OCR_VISION_FUSION_INPUT, après l'image).
+# Variables de OCR_VISION_FUSION_INPUT : {confidence}, {vision_context_handwritten},
+# {vision_context_printed}, {ocr_text}
 # ---------------------------------------------------------------------------
 
 OCR_VISION_FUSION_PROMPT = """Tu es un expert en consolidation factuelle de documents administratifs français.
@@ -83,7 +114,14 @@ Priorité absolue à l’exactitude des :
 • Numéros (facture, contrat, IBAN, SIRET)
 • Noms d’organismes
 
-Score de confiance OCR : {confidence}%
+Le message utilisateur contient l'image, puis le score de confiance OCR,
+les deux analyses vision et le texte OCR.
+
+Retourne uniquement le texte final consolidé.
+Aucun commentaire.
+Aucune explication."""
+
+OCR_VISION_FUSION_INPUT = """Score de confiance OCR : {confidence}%
 
 Vision — texte manuscrit :
 {vision_context_handwritten}
@@ -92,11 +130,7 @@ Vision — texte imprimé :
 {vision_context_printed}
 
 Texte OCR :
-{ocr_text}
-
-Retourne uniquement le texte final consolidé.
-Aucun commentaire.
-Aucune explication."""
+{ocr_text}"""
 
 
 # ---------------------------------------------------------------------------
@@ -131,6 +165,16 @@ Règles strictes :
 - Ne rien ajouter en dehors du JSON."""
 
 
+# ---------------------------------------------------------------------------
+# Recherche assistée (question + extraits de documents → réponse)
+# ---------------------------------------------------------------------------
+
+SEARCH_SYSTEM_PROMPT = (
+    "Tu es un assistant qui aide à retrouver des informations dans des documents administratifs. "
+    "Réponds en français, de façon concise, uniquement à partir des documents fournis."
+)
+
+
 # ---------------------------------------------------------------------------
 # Classification d'emails (sujet + expéditeur → catégorie)
 # ---------------------------------------------------------------------------
@@ -143,3 +187,17 @@ Facture = reçu, invoice, confirmation de paiement.
 Notification = alerte système, 2FA, confirmation inscription.
 Personnel = échange humain direct.
 Autre = tout le reste."""
+
+
+# Même classification pour un lot d'emails numérotés (purge des promotionnels)
+EMAIL_BATCH_CLASSIFIER_PROMPT = """Tu es un classificateur d'emails. \
+Tu reçois une liste numérotée d'emails (sujet et expéditeur). \
+Pour CHACUN, dans l'ordre, choisis UNE catégorie parmi : \
+Promotionnel, Facture, Notification, Personnel, Autre.
+Promotionnel = newsletter, pub, offre commerciale, soldes, marketing.
+Facture = reçu, invoice, confirmation de paiement.
+Notification = alerte système, 2FA, confirmation inscription.
+Personnel = échange humain direct.
+Autre = tout le reste.
+Réponds UNIQUEMENT avec un objet JSON : {"categories": ["...", "..."]}
+contenant exactement une catégorie par email, dans l'ordre de la liste."""
@@ -1,56 +1,122 @@
 """
 services/processing.py — Traitement OCR + LLM en arrière-plan.
+
+Les documents à traiter passent par une file asyncio consommée par
+PROCESSING_CONCURRENCY workers : un afflux de fichiers (watcher, email)
+ne lance plus un thread par document.
 """
 import os
+import json
+import asyncio
 import logging
+import threading
+
+from fastapi.concurrency import run_in_threadpool
+
+from sqlalchemy import update
 
 from database import SessionLocal, Document
-from processor import process_document, generate_text_pdf
-from core.config import UPLOAD_DIR
+from processor import process_document, generate_text_pdf, forget_llm_cache, IMAGE_EXTS
+from enhance import enhance_image
+from core.config import UPLOAD_DIR, PROCESSING_CONCURRENCY
 
 logger = logging.getLogger(__name__)
 
 
 def run_processing(doc_id: int, file_path: str):
-    """Traite un document (OCR + LLM) et met à jour la DB."""
-    db = SessionLocal()
+    """Traite un document (OCR + LLM) et met à jour la DB en un seul UPDATE."""
+    is_image = os.path.splitext(file_path)[1].lower() in IMAGE_EXTS
+    # Image améliorée une seule fois : servie à l'OCR puis au PDF searchable
+    enhanced_path = enhance_image(file_path, output_dir=None) if is_image else None
     try:
-        text, analysis = process_document(file_path)
-        doc = db.query(Document).filter(Document.id == doc_id).first()
-        if doc:
-            doc.content  = text
-            doc.category = analysis.get("category")
-            doc.summary  = analysis.get("summary")
-            doc.doc_date = analysis.get("date")
-            doc.amount   = analysis.get("amount")
-            doc.issuer   = analysis.get("issuer")
-            # Sources du pipeline (ex: ["vision","ocr+llm"] ou None)
-            sources = analysis.get("pipeline_sources")
-            if sources:
-                import json as _json
-                doc.pipeline_sources = _json.dumps(sources)
-
-            # Générer un PDF searchable si la source est une image
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext in (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".webp"):
-                base_name = os.path.splitext(os.path.basename(file_path))[0]
-                meta = {
-                    "category": doc.category,
-                    "summary":  doc.summary,
-                    "date":     doc.doc_date,
-                    "amount":   doc.amount,
-                    "issuer":   doc.issuer,
-                }
-                pdf_path = generate_text_pdf(
-                    text, UPLOAD_DIR, base_name, meta,
-                    image_path=file_path,
-                )
-                if pdf_path:
-                    doc.pdf_filename = os.path.basename(pdf_path)
-
-            db.commit()
-            logger.info(f"[processor] Doc #{doc_id} traité : {analysis.get('category')} — {analysis.get('summary')}")
+        text, analysis = process_document(file_path, doc_id, enhanced_path=enhanced_path)
+        values = {
+            "content":  text,
+            "category": analysis.get("category"),
+            "summary":  analysis.get("summary"),
+            "doc_date": analysis.get("date"),
+            "amount":   analysis.get("amount"),
+            "issuer":   analysis.get("issuer"),
+        }
+        # Sources du pipeline (ex: ["vision","ocr+llm"] ou None)
+        sources = analysis.get("pipeline_sources")
+        if sources:
+            values["pipeline_sources"] = json.dumps(sources)
+
+        # Générer un PDF searchable si la source est une image
+        pdf_path = None
+        if is_image:
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            meta = {
+                "category": values["category"],
+                "summary":  values["summary"],
+                "date":     values["doc_date"],
+                "amount":   values["amount"],
+                "issuer":   values["issuer"],
+            }
+            pdf_path = generate_text_pdf(
+                text, UPLOAD_DIR, base_name, meta,
+                image_path=enhanced_path, image_enhanced=True,
+            )
+            if pdf_path:
+                values["pdf_filename"] = os.path.basename(pdf_path)
+
+        with SessionLocal.begin() as db:
+            updated = db.execute(
+                update(Document).where(Document.id == doc_id).values(**values)
+            ).rowcount
+            if not updated:
+                forget_llm_cache(db, doc_id)
+
+        if not updated:
+            # Document supprimé pendant le traitement : ne pas laisser de PDF orphelin
+            # ni ses réponses LLM en cache
+            if pdf_path and os.path.exists(pdf_path):
+                os.remove(pdf_path)
+            return
+        logger.info(f"[processor] Doc #{doc_id} traité : {analysis.get('category')} — {analysis.get('summary')}")
     except Exception as e:
         logger.error(f"[processor] Erreur doc {doc_id}: {e}")
     finally:
-        db.close()
+        if enhanced_path and enhanced_path != file_path and os.path.exists(enhanced_path):
+            try:
+                os.remove(enhanced_path)
+            except OSError:
+                pass
+
+
+# ---------------------------------------------------------------------------
+# File de traitement à concurrence bornée
+# ---------------------------------------------------------------------------
+
+_job_queue: asyncio.Queue | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+async def _worker():
+    while True:
+        doc_id, file_path = await _job_queue.get()
+        try:
+            await run_in_threadpool(run_processing, doc_id, file_path)
+        finally:
+            _job_queue.task_done()
+
+
+def start_processing_workers() -> list[asyncio.Task]:
+    """Crée la file et ses workers sur la boucle courante (à appeler au démarrage de l'app)."""
+    global _job_queue, _loop
+    _job_queue = asyncio.Queue()
+    _loop = asyncio.get_running_loop()
+    logger.info(f"[processor] File de traitement active ({PROCESSING_CONCURRENCY} workers)")
+    return [asyncio.create_task(_worker()) for _ in range(PROCESSING_CONCURRENCY)]
+
+
+def enqueue_processing(doc_id: int, file_path: str):
+    """
+    Ajoute un document à la file de traitement. Utilisable depuis n'importe quel thread.
+    Si les workers ne sont pas démarrés (ex: tests sans lifespan), traite dans un thread dédié.
+    """
+    if _loop is None or _loop.is_closed():
+        threading.Thread(target=run_processing, args=(doc_id, file_path), daemon=True).start()
+        return
+    _loop.call_soon_threadsafe(_job_queue.put_nowait, (doc_id, file_path))
@@ -1,49 +1,142 @@
 """
 services/watcher.py — Surveillance du dossier watch/ pour l'ingestion automatique.
 """
-import threading
+import os
 import logging
+import threading
 
 from database import SessionLocal, Document
 from core.config import WATCH_DIR
-from services.processing import run_processing
+from services.processing import enqueue_processing
 
 logger = logging.getLogger(__name__)
 
+# Extensions ingérées — filtrées par watchdog avant d'atteindre le handler Python
+_WATCH_EXTS = frozenset({".pdf", ".png", ".jpg", ".jpeg", ".tiff", ".bmp"})
+_WATCH_PATTERNS = ["*" + ext for ext in sorted(_WATCH_EXTS)]
+
+# Systèmes de fichiers où inotify ne remonte pas (ou mal) les événements
+_NETWORK_FS = {"cifs", "smb3", "smbfs", "nfs", "nfs4", "9p", "fuseblk"}
+
+# Regroupement des rafales d'événements (écriture puis renommage, rescan antivirus…)
+_DEBOUNCE_DELAY = 0.5   # secondes
+_pending: dict[str, threading.Timer] = {}
+_pending_lock = threading.Lock()
+
+# Observateur actif (un seul par processus, même si le démarrage est appelé deux fois)
+_observer = None
+_observer_lock = threading.Lock()
+
+
+def _is_network_mount(path: str) -> bool:
+    """Linux : True si path est sur un montage réseau/FUSE (d'après /proc/mounts)."""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    real = os.path.realpath(path)
+    best, fstype = "", ""
+    for mount_point, fs in mounts:
+        if (real == mount_point or real.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+            best, fstype = mount_point, fs
+    return fstype in _NETWORK_FS or fstype.startswith("fuse.")
+
+
+def _ingest(path: str, pending_only: bool = False):
+    """
+    Événement sur path : fichier surveillé → minuteur (re)lancé.
+    pending_only : ne fait que repousser un minuteur en cours (écriture qui se
+    poursuit), sans ingérer un fichier déjà traité que l'on modifierait ensuite.
+    """
+    # Observateur non récursif : le nom suit toujours le dernier séparateur
+    fname = path.rpartition(os.sep)[2]
+    _, dot, ext = fname.rpartition(".")
+    if not dot or "." + ext.lower() not in _WATCH_EXTS:
+        return
+    _schedule(path, fname, pending_only)
+
+
+def _schedule(path: str, fname: str, pending_only: bool = False):
+    """(Re)lance le minuteur du fichier : seul le dernier événement d'une rafale est traité."""
+    timer = threading.Timer(_DEBOUNCE_DELAY, _enqueue, args=(path, fname))
+    timer.daemon = True
+    with _pending_lock:
+        previous = _pending.get(path)
+        if previous is None and pending_only:
+            return
+        if previous is not None:
+            previous.cancel()
+        _pending[path] = timer
+    timer.start()
+
+
+def _enqueue(path: str, fname: str):
+    """Crée l'entrée DB et met le fichier en file de traitement."""
+    with _pending_lock:
+        # Timer remplacé entre son déclenchement et ici → le plus récent s'en charge
+        if _pending.get(path) is not threading.current_thread():
+            return
+        del _pending[path]
+    if not os.path.isfile(path):
+        return
+    logger.info(f"[watcher] Nouveau fichier détecté : {fname}")
+    db = SessionLocal()
+    try:
+        db_doc = Document(filename=fname, content=None, category=None, summary=None)
+        db.add(db_doc)
+        db.commit()
+        db.refresh(db_doc)
+        enqueue_processing(db_doc.id, path)
+    finally:
+        db.close()
+
 
 def start_folder_watcher():
-    """Lance watchdog en arrière-plan sur WATCH_DIR."""
+    """Lance watchdog en arrière-plan sur WATCH_DIR (sans effet s'il tourne déjà)."""
+    with _observer_lock:
+        if _observer is not None:
+            return
+        _start_observer()
+
+
+def _make_handler():
+    """Handler watchdog : création/renommage ouvrent le minuteur, écritures le repoussent."""
+    from watchdog.events import PatternMatchingEventHandler
+
+    class _Handler(PatternMatchingEventHandler):
+        def on_created(self, event):
+            _ingest(event.src_path)
+
+        def on_moved(self, event):
+            # Beaucoup d'applications écrivent un fichier temporaire puis le renomment
+            _ingest(event.dest_path)
+
+        def on_modified(self, event):
+            # Copie lente : chaque écriture repousse l'ingestion jusqu'à la fin
+            _ingest(event.src_path, pending_only=True)
+
+        def on_closed(self, event):
+            # Fermeture après écriture (inotify seulement)
+            _ingest(event.src_path, pending_only=True)
+
+    return _Handler(patterns=_WATCH_PATTERNS, ignore_directories=True)
+
+
+def _start_observer():
+    global _observer
     try:
         from watchdog.observers import Observer
-        from watchdog.events import FileSystemEventHandler
-
-        class _Handler(FileSystemEventHandler):
-            def on_created(self, event):
-                if event.is_directory:
-                    return
-                import os
-                fname = os.path.basename(event.src_path)
-                ext = os.path.splitext(fname)[1].lower()
-                if ext not in (".pdf", ".png", ".jpg", ".jpeg", ".tiff", ".bmp"):
-                    return
-                logger.info(f"[watcher] Nouveau fichier détecté : {fname}")
-                db = SessionLocal()
-                try:
-                    db_doc = Document(filename=fname, content=None, category=None, summary=None)
-                    db.add(db_doc)
-                    db.commit()
-                    db.refresh(db_doc)
-                    threading.Thread(
-                        target=run_processing,
-                        args=(db_doc.id, event.src_path),
-                        daemon=True,
-                    ).start()
-                finally:
-                    db.close()
-
-        observer = Observer()
-        observer.schedule(_Handler(), WATCH_DIR, recursive=False)
+        from watchdog.observers.polling import PollingObserver
+
+        if _is_network_mount(WATCH_DIR):
+            observer = PollingObserver(timeout=2.0)
+            logger.info("[watcher] Montage réseau détecté → PollingObserver")
+        else:
+            observer = Observer()
+        observer.schedule(_make_handler(), WATCH_DIR, recursive=False)
         observer.start()
+        _observer = observer
         logger.info(f"[watcher] Surveillance active sur : {WATCH_DIR}")
     except Exception as e:
         logger.error(f"[watcher] Impossible de démarrer : {e}")
@@ -0,0 +1,58 @@
+"""
+test_enhance.py — Tests du prétraitement d'image (redressement)
+"""
+import cv2
+import numpy as np
+
+import enhance
+
+
+# Document photographié en biais : quadrilatère blanc sur fond sombre, repère
+# rouge près du coin haut-gauche (BGR)
+_QUAD = np.array([[150, 80], [620, 110], [650, 540], [120, 520]], dtype=np.int32)
+_MARKER = (210, 150)
+_ANGLE = 4.0
+
+
+def _skewed_document() -> np.ndarray:
+    img = np.full((600, 800, 3), 30, dtype=np.uint8)
+    cv2.fillConvexPoly(img, _QUAD, (255, 255, 255))
+    cv2.circle(img, _MARKER, 12, (0, 0, 255), -1)
+    return img
+
+
+def _marker_centroid(img: np.ndarray) -> np.ndarray:
+    mask = (img[..., 2] > 150) & (img[..., 0] < 100)
+    ys, xs = np.nonzero(mask)
+    return np.array([xs.mean(), ys.mean()])
+
+
+def test_straighten_matches_two_step_pipeline(monkeypatch):
+    """Un seul warp composé (R @ M) ≡ déperspective puis rotation séparées."""
+    # Angle fixé : l'estimation de _deskew dépend de la convention de minAreaRect
+    # selon la version d'OpenCV ; seule la composition des matrices est testée ici
+    monkeypatch.setattr(enhance, "_deskew", lambda gray: _ANGLE)
+    img = _skewed_document()
+
+    perspective = enhance._correct_perspective(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+    assert perspective is not None
+    M, size = perspective
+    warped = cv2.warpPerspective(img, M, size)
+    R = cv2.getRotationMatrix2D((size[0] // 2, size[1] // 2), _ANGLE, 1.0)
+    expected = cv2.warpAffine(warped, R, size,
+                              flags=cv2.INTER_CUBIC,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+    result = enhance._straighten(img)
+
+    assert result.shape == expected.shape == (size[1], size[0], 3)
+    assert np.linalg.norm(_marker_centroid(result) - _marker_centroid(expected)) < 1.5
+    diff = np.abs(result.astype(np.int16) - expected.astype(np.int16))
+    assert diff.mean() < 3.0
+
+
+def test_straighten_returns_input_when_nothing_to_fix(monkeypatch):
+    monkeypatch.setattr(enhance, "_correct_perspective", lambda gray: None)
+    monkeypatch.setattr(enhance, "_deskew", lambda gray: None)
+    img = _skewed_document()
+    assert enhance._straighten(img) is img
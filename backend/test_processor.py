@@ -0,0 +1,227 @@
+"""
+test_processor.py — Tests du pipeline de traitement (cache LLM, découpage OCR)
+"""
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import database
+import processor
+from database import LLMCacheEntry
+
+
+# ---------------------------------------------------------------------------
+# Cache des réponses LLM
+# ---------------------------------------------------------------------------
+
+class _Clock:
+    """Horloge UTC naïve avançant d'une seconde à chaque lecture."""
+    def __init__(self):
+        self.now = datetime.datetime(2026, 1, 1)
+
+    def __call__(self):
+        self.now += datetime.timedelta(seconds=1)
+        return self.now
+
+
+@pytest.fixture
+def llm_cache_db(monkeypatch):
+    """Table llm_cache dans une base SQLite en mémoire, cache mémoire vidé."""
+    engine = create_engine("sqlite://")
+    LLMCacheEntry.__table__.create(engine)
+    session = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", session)
+    monkeypatch.setattr(database, "utcnow", _Clock())
+    processor._llm_cache.clear()
+    yield session
+    processor._llm_cache.clear()
+
+
+def _cached_keys(session):
+    with session() as db:
+        return set(db.scalars(select(LLMCacheEntry.key)))
+
+
+def test_llm_cache_load_returns_stored_entry(llm_cache_db):
+    processor._llm_cache_store("k1", 7, "réponse")
+    assert processor._llm_cache_load("k1") == (7, "réponse")
+    assert processor._llm_cache_load("absente") is None
+
+
+def test_llm_cache_load_drops_expired_entry(llm_cache_db):
+    with llm_cache_db.begin() as db:
+        db.add(LLMCacheEntry(
+            key="vieille", doc_id=1, content="x",
+            used_at=datetime.datetime(2026, 1, 1) - processor._LLM_DB_CACHE_TTL - datetime.timedelta(days=1),
+        ))
+    assert processor._llm_cache_load("vieille") is None
+    assert _cached_keys(llm_cache_db) == set()
+
+
+def test_llm_cache_store_evicts_least_recently_used(llm_cache_db, monkeypatch):
+    monkeypatch.setattr(processor, "_LLM_DB_CACHE_SIZE", 2)
+    processor._llm_cache_store("a", 1, "A")
+    processor._llm_cache_store("b", 1, "B")
+    processor._llm_cache_load("a")  # "a" redevient la plus récente
+    processor._llm_cache_store("c", 1, "C")
+    assert _cached_keys(llm_cache_db) == {"a", "c"}
+
+
+def test_forget_llm_cache_removes_document_entries(llm_cache_db):
+    processor._llm_cache_store("doc1", 1, "texte du document 1")
+    processor._llm_cache_store("doc2", 2, "texte du document 2")
+    processor._llm_cache_remember("doc1", 1, "texte du document 1")
+    processor._llm_cache_remember("doc2", 2, "texte du document 2")
+
+    with llm_cache_db.begin() as db:
+        processor.forget_llm_cache(db, 1)
+
+    assert _cached_keys(llm_cache_db) == {"doc2"}
+    assert list(processor._llm_cache) == ["doc2"]
+
+
+def test_chat_completion_caches_per_document(llm_cache_db):
+    calls = []
+
+    def create(**request):
+        calls.append(request)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="ok"))])
+
+    client = SimpleNamespace(
+        base_url="http://llm.local/v1",
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+    )
+    token = processor._llm_cache_doc.set(3)
+    try:
+        assert processor._chat_completion(client, str.upper, model="m", messages=[]) == "OK"
+    finally:
+        processor._llm_cache_doc.reset(token)
+
+    processor._llm_cache.clear()  # la seconde lecture passe par la base
+    assert processor._chat_completion(client, str.upper, model="m", messages=[]) == "OK"
+    assert len(calls) == 1
+    with llm_cache_db() as db:
+        assert db.scalars(select(LLMCacheEntry.doc_id)).all() == [3]
+
+
+# ---------------------------------------------------------------------------
+# Découpage par page de la sortie TSV de Tesseract
+# ---------------------------------------------------------------------------
+
+_TSV_HEADER = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext"
+
+
+def _tsv_row(level, page, block, par, line, word, conf, text=""):
+    return "\t".join(map(str, (level, page, block, par, line, word, 0, 0, 10, 10, conf, text)))
+
+
+def test_pages_from_ocr_data_keeps_empty_middle_page():
+    tsv = "\n".join([
+        _TSV_HEADER,
+        _tsv_row(1, 1, 0, 0, 0, 0, -1),
+        _tsv_row(5, 1, 1, 1, 1, 1, 90, "Facture"),
+        _tsv_row(5, 1, 1, 1, 1, 2, 80, "EDF"),
+        _tsv_row(1, 2, 0, 0, 0, 0, -1),
+        _tsv_row(1, 3, 0, 0, 0, 0, -1),
+        _tsv_row(5, 3, 1, 1, 1, 1, 70, "Total"),
+        _tsv_row(5, 3, 2, 1, 1, 1, 50, "42€"),
+    ])
+    pages = processor._pages_from_ocr_data(tsv, 3)
+    assert pages == [
+        ("Facture EDF", pytest.approx(85.0), 2),
+        ("", 0.0, 0),
+        ("Total\n\n42€", pytest.approx(60.0), 2),
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Instances tesserocr
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def fake_tesserocr(monkeypatch):
+    """Module tesserocr factice ; file d'instances et créneaux OCR (2) neufs."""
+    import queue
+    import sys
+    import threading
+    import time
+    import types
+
+    created = []
+
+    class FakeAPI:
+        def __init__(self, lang):
+            created.append(self)
+
+        def SetImage(self, img):
+            time.sleep(0.01)
+
+        def GetUTF8Text(self):
+            return "texte"
+
+        def AllWordConfidences(self):
+            return [90]
+
+        def Clear(self):
+            pass
+
+    module = types.SimpleNamespace(PyTessBaseAPI=FakeAPI)
+    monkeypatch.setitem(sys.modules, "tesserocr", module)
+    monkeypatch.setattr(processor, "_tess_pool", queue.SimpleQueue())
+    monkeypatch.setattr(processor, "_ocr_slots", threading.BoundedSemaphore(2))
+    monkeypatch.setattr(processor, "_prepare_for_ocr", lambda img: img)
+    processor._load_tesserocr.cache_clear()
+    yield module, created
+    processor._load_tesserocr.cache_clear()
+
+
+def test_tesserocr_instances_bounded_by_ocr_slots(fake_tesserocr):
+    import concurrent.futures
+    from PIL import Image
+
+    _, created = fake_tesserocr
+    img = Image.new("L", (10, 10))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: processor._ocr_image(img), range(32)))
+    assert results == [("texte", 90.0)] * 32
+    assert 1 <= len(created) <= 2
+
+
+def test_tesserocr_failure_logged_once(fake_tesserocr, monkeypatch, caplog):
+    import logging
+    from PIL import Image
+
+    module, _ = fake_tesserocr
+
+    def broken(lang):
+        raise RuntimeError("fra.traineddata introuvable")
+
+    monkeypatch.setattr(module, "PyTessBaseAPI", broken)
+    monkeypatch.setattr(processor.pytesseract, "image_to_data", lambda img, lang: _TSV_HEADER)
+    caplog.set_level(logging.WARNING)
+    img = Image.new("L", (10, 10))
+    for _ in range(3):
+        assert processor._ocr_image(img) == ("", 0.0)
+    assert caplog.text.count("tesserocr indisponible") == 1
+
+
+# ---------------------------------------------------------------------------
+# Budget de tokens
+# ---------------------------------------------------------------------------
+
+def test_token_encoder_never_downloads_vocab(monkeypatch, tmp_path):
+    import sys
+    monkeypatch.setitem(sys.modules, "tiktoken", None)  # tout import échouerait
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))  # dossier vide
+    processor._load_token_encoder.cache_clear()
+    try:
+        assert processor._token_encoder() is None
+        text = "a" * 40_000
+        clipped = processor._clip_tokens(text, 1000)
+        assert processor._CLIP_MARKER in clipped
+        assert len(clipped) <= 1000 * processor._CHARS_PER_TOKEN + len(processor._CLIP_MARKER)
+    finally:
+        processor._load_token_encoder.cache_clear()
@@ -10,6 +10,15 @@ from datetime import timedelta
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def _clear_auth_cache():
+    """Cache des tokens vérifiés vidé entre les tests : ils restent indépendants de l'ordre."""
+    from core import security
+    security._auth_cache.clear()
+    yield
+    security._auth_cache.clear()
+
+
 # ---------------------------------------------------------------------------
 # Tests d'authentification JWT
 # ---------------------------------------------------------------------------
@@ -91,6 +100,87 @@ def test_token_expiration():
     assert response.status_code == 401
 
 
+# ---------------------------------------------------------------------------
+# Tests du cache des tokens vérifiés
+# ---------------------------------------------------------------------------
+
+class _FakeUsers:
+    """Session minimale pour get_current_user : recherche par id et par username."""
+    def __init__(self, *users):
+        self.users = {user.id: user for user in users}
+
+    def get(self, model, user_id):
+        return self.users.get(user_id)
+
+    def execute(self, statement, params):
+        from types import SimpleNamespace
+        user = next((u for u in self.users.values() if u.username == params["username"]), None)
+        return SimpleNamespace(scalar_one_or_none=lambda: user)
+
+
+def _bearer(token):
+    from fastapi.security import HTTPAuthorizationCredentials
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+def _user(user_id, username):
+    from types import SimpleNamespace
+    return SimpleNamespace(id=user_id, username=username)
+
+
+def test_auth_cache_rejects_deleted_user():
+    """Un token en cache ne donne plus accès une fois l'utilisateur supprimé."""
+    from fastapi import HTTPException
+    from core.security import get_current_user
+
+    db = _FakeUsers(_user(1, "alice"))
+    token = create_access_token(data={"sub": "alice"})
+    assert get_current_user(_bearer(token), db).id == 1  # mis en cache
+
+    del db.users[1]
+    with pytest.raises(HTTPException) as exc:
+        get_current_user(_bearer(token), db)
+    assert exc.value.status_code == 401
+
+
+def test_auth_cache_does_not_serve_expired_token():
+    """Une entrée échue n'est pas servie : le token expiré est revérifié et refusé."""
+    import hashlib
+    import time
+    from fastapi import HTTPException
+    from core import security
+
+    db = _FakeUsers(_user(1, "alice"))
+    token = create_access_token(data={"sub": "alice"}, expires_delta=timedelta(seconds=5))
+    security.get_current_user(_bearer(token), db)
+    key = hashlib.sha256(token.encode()).digest()
+    # Validité en cache bornée par l'expiration du token
+    assert security._auth_cache[key][1] <= verify_token(token)["exp"]
+
+    expired = create_access_token(data={"sub": "alice"}, expires_delta=timedelta(seconds=-10))
+    security._auth_cache[hashlib.sha256(expired.encode()).digest()] = (1, time.time() - 1)
+    with pytest.raises(HTTPException) as exc:
+        security.get_current_user(_bearer(expired), db)
+    assert exc.value.status_code == 401
+
+
+def test_auth_cache_evicts_oldest_entry(monkeypatch):
+    """Au-delà de _AUTH_CACHE_MAX, l'entrée la plus ancienne est évincée."""
+    import hashlib
+    from core import security
+
+    monkeypatch.setattr(security, "_AUTH_CACHE_MAX", 3)
+    db = _FakeUsers(_user(1, "alice"))
+    tokens = [create_access_token(data={"sub": "alice", "n": i}) for i in range(4)]
+    for token in tokens:
+        security.get_current_user(_bearer(token), db)
+
+    keys = [hashlib.sha256(token.encode()).digest() for token in tokens]
+    assert len(security._auth_cache) == 3
+    assert keys[0] not in security._auth_cache
+    assert all(key in security._auth_cache for key in keys[1:])
+
+
 # ---------------------------------------------------------------------------
 # Tests de validation des uploads
 # ---------------------------------------------------------------------------
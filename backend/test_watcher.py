@@ -0,0 +1,70 @@
+"""
+test_watcher.py — Tests de l'ingestion du dossier watch/ (regroupement des événements)
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+from watchdog.events import FileCreatedEvent, FileModifiedEvent
+
+from services import watcher
+
+
+class _FakeSession:
+    """Session minimale pour _enqueue : attribue un id au document ajouté."""
+    next_id = 1
+
+    def add(self, doc):
+        self.doc = doc
+
+    def commit(self):
+        pass
+
+    def refresh(self, doc):
+        doc.id = _FakeSession.next_id
+        _FakeSession.next_id += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    """Documents mis en file par le watcher, sans DB ni workers réels."""
+    calls = []
+    monkeypatch.setattr(watcher, "_DEBOUNCE_DELAY", 0.2)
+    monkeypatch.setattr(watcher, "SessionLocal", _FakeSession)
+    monkeypatch.setattr(watcher, "Document", lambda **kwargs: SimpleNamespace(**kwargs))
+    monkeypatch.setattr(watcher, "enqueue_processing", lambda doc_id, path: calls.append((doc_id, path)))
+    yield calls
+    with watcher._pending_lock:
+        for timer in watcher._pending.values():
+            timer.cancel()
+        watcher._pending.clear()
+
+
+def test_slow_copy_enqueued_once_after_last_write(enqueued, tmp_path):
+    """Des écritures espacées de moins que le délai repoussent l'ingestion jusqu'à la dernière."""
+    path = str(tmp_path / "scan.pdf")
+    handler = watcher._make_handler()
+
+    with open(path, "wb") as f:
+        handler.dispatch(FileCreatedEvent(path))
+        for _ in range(4):  # copie qui dure ~2x le délai
+            time.sleep(0.1)
+            f.write(b"%PDF-1.4\n")
+            f.flush()
+            handler.dispatch(FileModifiedEvent(path))
+        assert enqueued == []  # toujours en cours d'écriture
+
+    time.sleep(0.5)
+    assert [p for _, p in enqueued] == [path]
+
+
+def test_modified_without_pending_timer_is_ignored(enqueued, tmp_path):
+    """Une modification d'un fichier déjà ingéré ne le remet pas en file."""
+    path = tmp_path / "deja_traite.pdf"
+    path.write_bytes(b"%PDF-1.4\n")
+    watcher._make_handler().dispatch(FileModifiedEvent(str(path)))
+    time.sleep(0.4)
+    assert enqueued == []